@@ -0,0 +1,223 @@
+"""
+Audio helpers shared by the WhatsApp bots
+Transcodes voice notes for upload, splits long ones into overlapping chunks
+and stitches transcripts back together
+"""
+
+import io
+import re
+import logging
+from typing import List, Optional, Tuple
+
+# pydub (+ FFmpeg) is only needed for long voice notes - short ones are uploaded as-is
+try:
+    from pydub import AudioSegment
+    from pydub.silence import detect_silence
+except ImportError:
+    AudioSegment = None
+    detect_silence = None
+
+logger = logging.getLogger(__name__)
+
+# Silence detection settings (tuned for phone voice notes)
+MIN_SILENCE_MS = 400
+SILENCE_THRESH_OFFSET_DB = 16
+SILENCE_SEARCH_WINDOW_MS = 10_000
+
+# Max number of words compared when removing duplicates at chunk seams
+MAX_SEAM_WORDS = 25
+
+# Compressed formats Whisper accepts as-is (WAV is accepted too, but is never worth uploading)
+WHISPER_COMPRESSED_FORMATS = {'flac', 'mp3', 'mp4', 'mpeg', 'mpga', 'm4a', 'ogg', 'oga', 'webm'}
+
+# Container aliases - WhatsApp voice notes arrive as audio/ogg or audio/opus (both Ogg Opus)
+FORMAT_ALIASES = {'opus': 'ogg', 'x-m4a': 'm4a', 'mp4a-latm': 'm4a', 'x-wav': 'wav', 'wave': 'wav'}
+
+# Mono 16 kHz is all Whisper uses; 24 kbps Opus is plenty for speech
+TARGET_SAMPLE_RATE = 16000
+OPUS_BITRATE = '24k'
+
+# Flipped off the first time FFmpeg turns out to lack libopus
+_opus_available = True
+
+
+def load_audio(audio_data: bytes, audio_format: str):
+    """Decode audio bytes with pydub, or return None if that isn't possible"""
+    if AudioSegment is None:
+        return None
+    try:
+        return AudioSegment.from_file(io.BytesIO(audio_data), format=audio_format)
+    except Exception as e:
+        logger.warning(f"Could not decode {audio_format} audio: {e}")
+        return None
+
+
+def transcode_for_upload(audio_data: bytes, audio_format: str,
+                         accepted_formats=WHISPER_COMPRESSED_FORMATS) -> Tuple[bytes, str]:
+    """
+    Prepare audio for a transcription upload, entirely in memory
+
+    Audio already in an accepted compressed format is passed through untouched.
+    Anything else (WAV, AMR, ...) is downmixed to mono 16 kHz and re-encoded as
+    Ogg Opus, or FLAC if FFmpeg was built without libopus.
+
+    Args:
+        audio_data: Raw audio bytes
+        audio_format: Audio format (ogg, mp3, wav, amr, etc.)
+        accepted_formats: Formats the provider accepts without conversion
+
+    Returns:
+        (bytes to upload, format of those bytes)
+    """
+    audio_format = FORMAT_ALIASES.get(audio_format, audio_format)
+    if audio_format in accepted_formats:
+        return audio_data, audio_format
+
+    audio = load_audio(audio_data, audio_format)
+    if audio is None:
+        # Let the provider have a go at the original rather than failing here
+        return audio_data, audio_format
+    return encode_for_upload(audio.set_channels(1).set_frame_rate(TARGET_SAMPLE_RATE), accepted_formats)
+
+
+def encode_for_upload(audio, accepted_formats=WHISPER_COMPRESSED_FORMATS) -> Tuple[bytes, str]:
+    """
+    Encode a (mono 16 kHz) pydub AudioSegment as Ogg Opus, or FLAC without libopus
+
+    Returns:
+        (encoded bytes, format of those bytes)
+    """
+    global _opus_available
+    if _opus_available and 'ogg' in accepted_formats:
+        try:
+            buffer = io.BytesIO()
+            audio.export(buffer, format='ogg', codec='libopus', bitrate=OPUS_BITRATE)
+            return buffer.getvalue(), 'ogg'
+        except Exception as e:
+            _opus_available = False
+            logger.warning(f"Opus encoding unavailable, using FLAC: {e}")
+
+    buffer = io.BytesIO()
+    audio.export(buffer, format='flac')
+    return buffer.getvalue(), 'flac'
+
+
+def find_split_points(audio, chunk_ms: int) -> List[int]:
+    """
+    Pick chunk boundaries close to every `chunk_ms`, snapped to the middle of a silence
+
+    Only the search window before each cut is scanned for silence, not the whole note.
+
+    Args:
+        audio: pydub AudioSegment (already mono 16 kHz - scanning is per sample)
+        chunk_ms: Target chunk length in milliseconds
+
+    Returns:
+        Sorted list of boundaries (ms), including 0 and the end of the audio
+    """
+    duration = len(audio)
+    silence_thresh = audio.dBFS - SILENCE_THRESH_OFFSET_DB
+
+    points = [0]
+    while duration - points[-1] > chunk_ms:
+        target = points[-1] + chunk_ms
+        # Only look at silences that keep the chunk between half and full length
+        low = max(points[-1] + chunk_ms // 2, target - SILENCE_SEARCH_WINDOW_MS)
+        silences = detect_silence(
+            audio[low:target],
+            min_silence_len=MIN_SILENCE_MS,
+            silence_thresh=silence_thresh,
+            seek_step=10
+        )
+        if silences:
+            # Latest pause in the window (keeps chunks as long as allowed)
+            start, end = silences[-1]
+            points.append(low + (start + end) // 2)
+        else:
+            # No pause nearby - hard cut, the overlap covers the cut word
+            points.append(target)
+    points.append(duration)
+    return points
+
+
+def split_audio(audio, chunk_ms: int, overlap_ms: int,
+                accepted_formats=WHISPER_COMPRESSED_FORMATS) -> List[Tuple[bytes, str]]:
+    """
+    Split audio at silence boundaries into chunks with a small overlap
+
+    Args:
+        audio: pydub AudioSegment
+        chunk_ms: Target chunk length in milliseconds
+        overlap_ms: Audio repeated on each side of a boundary
+        accepted_formats: Formats the provider accepts (chunks are Opus when possible)
+
+    Returns:
+        (encoded chunk, format) pairs, in order
+    """
+    # Whisper only needs mono 16 kHz - keeps every chunk small and the silence scan cheap
+    audio = audio.set_channels(1).set_frame_rate(TARGET_SAMPLE_RATE)
+    points = find_split_points(audio, chunk_ms)
+
+    chunks = []
+    for start, end in zip(points, points[1:]):
+        segment = audio[max(0, start - overlap_ms):min(len(audio), end + overlap_ms)]
+        # Same encoding as single uploads - FLAC would be several times the Opus source
+        chunks.append(encode_for_upload(segment, accepted_formats))
+    return chunks
+
+
+def _normalize_word(word: str) -> str:
+    return re.sub(r"[^\w']", '', word.lower())
+
+
+def _seam_overlap(previous: List[str], current: List[str]) -> int:
+    """Length of the longest run of words ending `previous` that also starts `current`"""
+    prev_norm = [_normalize_word(w) for w in previous[-MAX_SEAM_WORDS:]]
+    curr_norm = [_normalize_word(w) for w in current[:MAX_SEAM_WORDS]]
+    for size in range(min(len(prev_norm), len(curr_norm)), 0, -1):
+        if prev_norm[-size:] == curr_norm[:size] and any(prev_norm[-size:]):
+            return size
+    return 0
+
+
+def merge_transcripts(parts: List[str]) -> str:
+    """
+    Join chunk transcripts in order, dropping words duplicated by the chunk overlap
+
+    Args:
+        parts: Transcripts of consecutive chunks
+
+    Returns:
+        Single transcript
+    """
+    words: List[str] = []
+    for part in parts:
+        part_words = (part or '').split()
+        overlap = _seam_overlap(words, part_words) if words else 0
+        words.extend(part_words[overlap:])
+    return ' '.join(words)
+
+
+def prepare_chunks(audio_data: bytes, audio_format: str, min_duration_ms: int,
+                   chunk_ms: int, overlap_ms: int) -> Optional[Tuple[List[Tuple[bytes, str]], int]]:
+    """
+    Chunk a long voice note for parallel transcription
+
+    Args:
+        audio_data: Raw audio bytes
+        audio_format: Audio format (ogg, mp3, wav, etc.)
+        min_duration_ms: Notes shorter than this are not chunked
+        chunk_ms: Target chunk length in milliseconds
+        overlap_ms: Overlap between neighbouring chunks
+
+    Returns:
+        ([(chunk, format)], duration_ms), or None when the note should go out in a single call
+    """
+    audio = load_audio(audio_data, audio_format)
+    if audio is None or len(audio) <= min_duration_ms:
+        return None
+
+    chunks = split_audio(audio, chunk_ms, overlap_ms)
+    if len(chunks) < 2:
+        return None
+    return chunks, len(audio)
@@ -0,0 +1,170 @@
+"""
+Consistent-hash partitioning of users across bot nodes
+Each sender number is owned by one node, so its conversation context, caches and
+rate limits stay in that node's memory. Webhooks that land elsewhere are forwarded.
+"""
+
+import bisect
+import hashlib
+import hmac
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Headers used between nodes
+FORWARDED_HEADER = 'X-Forwarded-By-Node'
+SECRET_HEADER = 'X-Cluster-Secret'
+
+
+def parse_nodes(raw: Optional[str]) -> Dict[str, str]:
+    """Parse "a=http://10.0.0.1:5000,b=http://10.0.0.2:5000" into {node_id: base_url}"""
+    nodes = {}
+    for item in (raw or '').split(','):
+        if '=' in item:
+            node_id, url = item.split('=', 1)
+            nodes[node_id.strip()] = url.strip().rstrip('/')
+    return nodes
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    def __init__(self, nodes: Optional[Dict[str, str]] = None, vnodes: int = 160):
+        """
+        Initialize the ring
+
+        Args:
+            nodes: node_id -> base URL
+            vnodes: Virtual points per node (more = more even spread)
+        """
+        self.vnodes = vnodes
+        self.nodes: Dict[str, str] = {}
+        self.points: List[Tuple[int, str]] = []
+        for node_id, url in (nodes or {}).items():
+            self.add_node(node_id, url)
+
+    def add_node(self, node_id: str, url: str):
+        """Join a node - only keys landing on its new points move to it"""
+        if node_id in self.nodes:
+            self.nodes[node_id] = url
+            return
+        self.nodes[node_id] = url
+        for i in range(self.vnodes):
+            bisect.insort(self.points, (_hash(f"{node_id}#{i}"), node_id))
+
+    def remove_node(self, node_id: str):
+        """Leave - only this node's keys move, to the next point on the ring"""
+        if self.nodes.pop(node_id, None) is not None:
+            self.points = [point for point in self.points if point[1] != node_id]
+
+    def get_node(self, key: str) -> Optional[str]:
+        """Node owning a key (first point clockwise from the key's hash)"""
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, (_hash(key), ''))
+        return self.points[index % len(self.points)][1]
+
+    def ownership(self) -> Dict[str, float]:
+        """Fraction of the hash space owned by each node"""
+        if not self.points:
+            return {}
+        shares = dict.fromkeys(self.nodes, 0)
+        space = 2 ** 64
+        previous = self.points[-1][0] - space
+        for position, node_id in self.points:
+            shares[node_id] += position - previous
+            previous = position
+        return {node_id: share / space for node_id, share in shares.items()}
+
+
+class ClusterRouter:
+    def __init__(self, node_id: str, nodes: Dict[str, str], secret: str = '',
+                 forward_timeout: float = 10.0):
+        """
+        Initialize the router
+
+        Args:
+            node_id: This node's id (must appear in nodes)
+            nodes: node_id -> base URL
+            secret: Shared secret required on forwarded/admin requests
+            forward_timeout: Seconds to wait for the owning node
+        """
+        self.node_id = node_id
+        self.secret = secret
+        self.forward_timeout = forward_timeout
+        self.ring = HashRing(nodes)
+        self.lock = threading.Lock()
+        # Keep-alive connections to the other nodes
+        self.session = requests.Session()
+        self.stats = {"local": 0, "forwarded": 0, "received": 0, "forward_errors": 0}
+
+    def owner(self, key: str) -> Tuple[str, str]:
+        """(node_id, base URL) of the node owning a key"""
+        with self.lock:
+            node_id = self.ring.get_node(key) or self.node_id
+            return node_id, self.ring.nodes.get(node_id, '')
+
+    def is_trusted(self, headers) -> bool:
+        """True for requests from another node (checked against the shared secret)"""
+        # No secret configured means nothing can prove it's a node
+        if not self.secret or FORWARDED_HEADER not in headers:
+            return False
+        return hmac.compare_digest(headers.get(SECRET_HEADER, ''), self.secret)
+
+    def forward(self, url: str, path: str, form: dict) -> Optional[Tuple[str, int]]:
+        """
+        Replay a webhook on its owning node
+
+        Returns:
+            (body, status) from the owner, or None if it couldn't be reached
+        """
+        try:
+            response = self.session.post(
+                f"{url}{path}",
+                data=form,
+                headers={FORWARDED_HEADER: self.node_id, SECRET_HEADER: self.secret},
+                timeout=self.forward_timeout
+            )
+            with self.lock:
+                self.stats["forwarded"] += 1
+            return response.text, response.status_code
+        except Exception as e:
+            logger.error(f"Error forwarding to {url}: {e}")
+            with self.lock:
+                self.stats["forward_errors"] += 1
+            return None
+
+    def count(self, stat: str):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def set_nodes(self, nodes: Dict[str, str]):
+        """Apply a membership change (nodes joining/leaving) with minimal key movement"""
+        with self.lock:
+            for node_id in list(self.ring.nodes):
+                if node_id not in nodes:
+                    self.ring.remove_node(node_id)
+            for node_id, url in nodes.items():
+                self.ring.add_node(node_id, url)
+        logger.info(f"Cluster membership updated: {sorted(nodes)}")
+
+    def get_stats(self, include_nodes: bool = False) -> dict:
+        """
+        Routing counters and ring shares
+
+        Args:
+            include_nodes: Add the node URLs (internal addresses - trusted callers only)
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["node_id"] = self.node_id
+            if include_nodes:
+                stats["nodes"] = dict(self.ring.nodes)
+            stats["ownership"] = self.ring.ownership()
+        return stats
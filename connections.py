@@ -0,0 +1,220 @@
+"""
+Connection warm-up and keep-alive for provider and Twilio clients
+Pooled HTTP clients are handed to the SDKs, pre-warmed when the worker starts and
+kept alive with cheap pings while idle, so the first request after boot (or after a
+quiet hour) doesn't pay for DNS + TCP + TLS setup
+"""
+
+import time
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# Set while a warm-up / keep-alive ping runs on this thread, so it isn't counted as traffic
+_ping_state = threading.local()
+
+
+class Backend:
+    def __init__(self, name: str, base_url: Optional[str], ping: Callable[[], None]):
+        self.name = name
+        self.base_url = base_url
+        self.ping = ping
+        self.open_connections: Callable[[], Optional[int]] = lambda: None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.handshakes = 0
+        self.pings = 0
+        self.ping_handshakes = 0
+        self.ping_errors = 0
+        self.last_used = 0.0
+
+    def touch(self):
+        if getattr(_ping_state, 'active', False):
+            return
+        with self.lock:
+            self.requests += 1
+            self.last_used = time.monotonic()
+
+    def count_handshake(self):
+        with self.lock:
+            if getattr(_ping_state, 'active', False):
+                self.ping_handshakes += 1
+            else:
+                self.handshakes += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            stats = {
+                "base_url": self.base_url,
+                "requests": self.requests,
+                "handshakes": self.handshakes,
+                "pings": self.pings,
+                "ping_handshakes": self.ping_handshakes,
+                "ping_errors": self.ping_errors,
+                "idle_seconds": round(time.monotonic() - self.last_used, 1) if self.last_used else None,
+            }
+        try:
+            stats["open_connections"] = self.open_connections()
+        except Exception:
+            stats["open_connections"] = None
+        if stats["requests"]:
+            stats["reuse_ratio"] = max(0.0, 1 - stats["handshakes"] / stats["requests"])
+        return stats
+
+
+def _counting_pool(base, backend: Backend):
+    """urllib3 pool class that counts new connections (each one is a TCP/TLS handshake)"""
+    class CountingPool(base):
+        def _new_conn(self):
+            backend.count_handshake()
+            return super()._new_conn()
+    return CountingPool
+
+
+class _CountingAdapter(HTTPAdapter):
+    def __init__(self, backend: Backend, **kwargs):
+        self.backend = backend
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool(HTTPConnectionPool, self.backend),
+            "https": _counting_pool(HTTPSConnectionPool, self.backend),
+        }
+
+    def send(self, request, **kwargs):
+        self.backend.touch()
+        return super().send(request, **kwargs)
+
+    def open_connections(self) -> int:
+        count = 0
+        for key in self.poolmanager.pools.keys():
+            pool = self.poolmanager.pools.get(key)
+            if pool is not None:
+                count += sum(1 for conn in list(pool.pool.queue) if conn is not None and conn.sock is not None)
+        return count
+
+
+class ConnectionManager:
+    def __init__(self, keepalive_interval: float = 240, pool_size: int = 10, ping_timeout: float = 5):
+        """
+        Initialize the manager
+
+        Args:
+            keepalive_interval: Ping a backend after this many idle seconds (0 = no pings)
+            pool_size: Max pooled connections per backend
+            ping_timeout: Timeout for warm-up / keep-alive requests
+        """
+        self.keepalive_interval = keepalive_interval
+        self.pool_size = pool_size
+        self.ping_timeout = ping_timeout
+        self.backends: Dict[str, Backend] = {}
+        self.stop_event = threading.Event()
+
+    def httpx_client(self, name: str, base_url: str) -> httpx.Client:
+        """Pooled httpx client for an SDK (Groq, OpenAI) that counts handshakes"""
+        client = None
+
+        def ping():
+            # Any response (even 401/404) means the connection is up
+            client.get(base_url, timeout=self.ping_timeout)
+
+        backend = Backend(name, base_url, ping)
+
+        def trace(event_name: str, info: dict):
+            if event_name == "connection.connect_tcp.complete":
+                backend.count_handshake()
+
+        def on_request(request: httpx.Request):
+            backend.touch()
+            request.extensions["trace"] = trace
+
+        client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+                keepalive_expiry=self.keepalive_interval + 60 if self.keepalive_interval else 5
+            ),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            event_hooks={"request": [on_request]}
+        )
+        backend.open_connections = lambda: len(client._transport._pool.connections)
+        self.backends[name] = backend
+        return client
+
+    def requests_session(self, name: str, base_url: str, session: Optional[requests.Session] = None) -> requests.Session:
+        """Mount a pooled, handshake-counting adapter on a requests session (Twilio, media downloads)"""
+        session = session or requests.Session()
+
+        def ping():
+            session.head(base_url, timeout=self.ping_timeout)
+
+        backend = Backend(name, base_url, ping)
+        adapter = _CountingAdapter(backend, pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        backend.open_connections = adapter.open_connections
+        self.backends[name] = backend
+        return session
+
+    def register_ping(self, name: str, ping: Callable[[], None]) -> Backend:
+        """
+        Backend whose SDK owns its transport (e.g. Gemini) - only warmed and pinged
+
+        Returns:
+            The backend - callers touch() it on each real request, so it isn't pinged
+            while busy and its request count is right
+        """
+        backend = self.backends[name] = Backend(name, None, ping)
+        return backend
+
+    def _ping(self, backend: Backend):
+        _ping_state.active = True
+        try:
+            backend.ping()
+            with backend.lock:
+                backend.pings += 1
+        except Exception as e:
+            logger.warning(f"Ping to {backend.name} failed: {e}")
+            with backend.lock:
+                backend.ping_errors += 1
+        finally:
+            _ping_state.active = False
+
+    def start(self):
+        """Warm every backend in the background, then keep idle ones alive"""
+        threading.Thread(target=self._run, name="connection-keepalive", daemon=True).start()
+
+    def _run(self):
+        started = time.monotonic()
+        for backend in self.backends.values():
+            self._ping(backend)
+        logger.info(f"Warmed {len(self.backends)} backend connections in {time.monotonic() - started:.2f}s")
+
+        if not self.keepalive_interval:
+            return
+        while not self.stop_event.wait(self.keepalive_interval / 4):
+            now = time.monotonic()
+            for backend in self.backends.values():
+                with backend.lock:
+                    idle = now - backend.last_used
+                if idle >= self.keepalive_interval:
+                    self._ping(backend)
+                    # Pings aren't counted as requests - restart the idle clock by hand
+                    with backend.lock:
+                        backend.last_used = now
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_stats(self) -> Dict[str, dict]:
+        """Per backend: open connections, requests, handshakes, reuse ratio, pings (counted apart)"""
+        return {name: backend.snapshot() for name, backend in self.backends.items()}
@@ -0,0 +1,241 @@
+"""
+Durable job journal (SQLite, WAL mode)
+Each incoming message is a job keyed by its Twilio MessageSid. Every finished stage
+(downloaded, transcribed / OCR'd, answered, sent) is appended with its output, so a
+restarted worker resumes from the last completed stage instead of paying for the
+same provider calls again, and a Twilio retry of a message already sent is ignored.
+"""
+
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Stage names, in pipeline order
+DOWNLOADED = 'downloaded'
+TRANSCRIBED = 'transcribed'
+OCR = 'ocr'
+ANSWERED = 'answered'
+SENT = 'sent'
+
+# Stages whose output came from a paid / quota-limited AI call
+PROVIDER_STAGES = {TRANSCRIBED, OCR, ANSWERED}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    from_number TEXT,
+    body TEXT,
+    media_url TEXT,
+    media_content_type TEXT,
+    num_media INTEGER,
+    owner TEXT,
+    created REAL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    job_id TEXT,
+    stage TEXT,
+    output BLOB,
+    is_text INTEGER,
+    created REAL,
+    PRIMARY KEY (job_id, stage)
+);
+CREATE TABLE IF NOT EXISTS workers (
+    token TEXT PRIMARY KEY,
+    heartbeat REAL
+);
+"""
+
+
+class JobJournal:
+    def __init__(self, path: str, heartbeat_seconds: float = 10, retention_hours: float = 24):
+        """
+        Open (or create) the journal
+
+        Args:
+            path: SQLite file
+            heartbeat_seconds: How often this worker proves it's alive
+            retention_hours: Jobs older than this are pruned (and never resumed)
+        """
+        self.path = path
+        self.heartbeat_seconds = heartbeat_seconds
+        self.retention_seconds = retention_hours * 3600
+        # Identifies this worker process as the owner of its in-flight jobs
+        self.token = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self._heartbeat()
+
+        self.stats = {
+            "jobs": 0,
+            "duplicates_skipped": 0,
+            "resumed_jobs": 0,
+            "stages_reused": 0,
+            "provider_calls_avoided": 0,
+            "recovery_seconds": 0.0,
+        }
+
+    def _heartbeat(self):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO workers (token, heartbeat) VALUES (?, ?)", (self.token, time.time())
+            )
+
+    def start_job(self, job_id: str, from_number: str, body: Optional[str], media_url: Optional[str],
+                  media_content_type: Optional[str], num_media: int) -> bool:
+        """
+        Record a new job as it arrives, before it is queued
+
+        Returns:
+            False if the job is already known (Twilio retry) - it is running, queued,
+            done or will be resumed, so skip it
+        """
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, from_number, body, media_url, media_content_type, num_media, self.token, time.time())
+            )
+            if not cursor.rowcount:
+                self.stats["duplicates_skipped"] += 1
+                return False
+            self.stats["jobs"] += 1
+        return True
+
+    def take(self, job_id: str) -> bool:
+        """
+        Make this worker the job's owner as it starts running (new or resumed)
+
+        Returns:
+            False if the job's reply was already sent - skip it
+        """
+        with self.lock:
+            if self._get_stage(job_id, SENT) is not None:
+                self.stats["duplicates_skipped"] += 1
+                return False
+            self.db.execute("UPDATE jobs SET owner = ? WHERE job_id = ?", (self.token, job_id))
+        return True
+
+    def _get_stage(self, job_id: str, stage: str) -> Optional[Union[str, bytes]]:
+        row = self.db.execute(
+            "SELECT output, is_text FROM stages WHERE job_id = ? AND stage = ?", (job_id, stage)
+        ).fetchone()
+        if row is None:
+            return None
+        output, is_text = row
+        return output.decode('utf-8') if is_text else bytes(output)
+
+    def get_stage(self, job_id: str, stage: str) -> Optional[Union[str, bytes]]:
+        """Output of a completed stage, or None"""
+        with self.lock:
+            output = self._get_stage(job_id, stage)
+            if output is not None and stage != SENT:
+                self.stats["stages_reused"] += 1
+                if stage in PROVIDER_STAGES:
+                    self.stats["provider_calls_avoided"] += 1
+        return output
+
+    def record(self, job_id: str, stage: str, output: Union[str, bytes] = b''):
+        """Append a completed stage (first write wins)"""
+        is_text = isinstance(output, str)
+        data = output.encode('utf-8') if is_text else output
+        with self.lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO stages VALUES (?, ?, ?, ?, ?)",
+                (job_id, stage, sqlite3.Binary(data), int(is_text), time.time())
+            )
+
+    def claim_orphans(self) -> List[Dict]:
+        """
+        Take over unsent jobs whose owner stopped heartbeating (crashed or restarted)
+
+        Returns:
+            Job fields for each claimed job, oldest first
+        """
+        stale_before = time.time() - 3 * self.heartbeat_seconds
+        cutoff = time.time() - self.retention_seconds
+        claimed = []
+        with self.lock:
+            rows = self.db.execute(
+                """
+                SELECT j.job_id, j.from_number, j.body, j.media_url, j.media_content_type, j.num_media, j.owner
+                FROM jobs j LEFT JOIN workers w ON w.token = j.owner
+                WHERE j.created >= ?
+                  AND (w.heartbeat IS NULL OR w.heartbeat < ?)
+                  AND NOT EXISTS (SELECT 1 FROM stages s WHERE s.job_id = j.job_id AND s.stage = ?)
+                ORDER BY j.created
+                """,
+                (cutoff, stale_before, SENT)
+            ).fetchall()
+            for job_id, from_number, body, media_url, media_content_type, num_media, owner in rows:
+                # Compare-and-set, so two workers never resume the same job
+                cursor = self.db.execute(
+                    "UPDATE jobs SET owner = ? WHERE job_id = ? AND owner IS ?", (self.token, job_id, owner)
+                )
+                if cursor.rowcount:
+                    claimed.append({
+                        "job_id": job_id,
+                        "from_number": from_number,
+                        "body": body,
+                        "media_url": media_url,
+                        "media_content_type": media_content_type,
+                        "num_media": num_media,
+                    })
+            self.stats["resumed_jobs"] += len(claimed)
+        return claimed
+
+    def prune(self):
+        """Drop jobs past the retention window and workers that are long gone"""
+        cutoff = time.time() - self.retention_seconds
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM stages WHERE job_id IN (SELECT job_id FROM jobs WHERE created < ?)", (cutoff,)
+            )
+            self.db.execute("DELETE FROM jobs WHERE created < ?", (cutoff,))
+            self.db.execute("DELETE FROM workers WHERE heartbeat < ?", (cutoff,))
+
+    def run_maintenance(self, resume):
+        """
+        Heartbeat, resume orphaned jobs and prune, forever (run in a daemon thread)
+
+        Args:
+            resume: Called with each claimed job's fields; returns a Future
+        """
+        started = time.monotonic()
+        prune_every = max(1, int(3600 / self.heartbeat_seconds))
+        ticks = 0
+        while True:
+            try:
+                if ticks % prune_every == 0:
+                    self.prune()
+                ticks += 1
+                self._heartbeat()
+                jobs = self.claim_orphans()
+                if jobs:
+                    logger.info(f"Resuming {len(jobs)} unfinished job(s) from the journal")
+                for job in jobs:
+                    resume(job).add_done_callback(lambda _: self._recovered(started))
+            except Exception as e:
+                logger.error(f"Job journal maintenance failed: {e}")
+            time.sleep(self.heartbeat_seconds)
+
+    def _recovered(self, started: float):
+        with self.lock:
+            self.stats["recovery_seconds"] = max(self.stats["recovery_seconds"], time.monotonic() - started)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+            stats["pending"] = self.db.execute(
+                "SELECT COUNT(*) FROM jobs j WHERE NOT EXISTS "
+                "(SELECT 1 FROM stages s WHERE s.job_id = j.job_id AND s.stage = ?)", (SENT,)
+            ).fetchone()[0]
+        return stats
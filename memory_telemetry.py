@@ -0,0 +1,198 @@
+"""
+Memory telemetry for the media paths
+Records peak traced allocation per request and per pipeline stage (tracemalloc), the
+largest allocation sites seen inside each stage, and process RSS gauges.
+
+tracemalloc is process-wide: peaks are exact while one request is in flight and an
+upper bound when requests overlap (reported as "overlapping"). Stages that run outside
+any request (e.g. outbound delivery threads) overlap whatever request is in flight.
+"""
+
+import os
+import random
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+_NULL_CONTEXT = nullcontext()
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def rss_bytes() -> Optional[int]:
+    """Current resident set size (Linux), or None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return None
+
+
+def max_rss_bytes() -> Optional[int]:
+    """Peak resident set size of the process, or None"""
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryTelemetry:
+    def __init__(self, enabled: bool = False, snapshot_rate: float = 0.1, top_n: int = 10, frames: int = 1):
+        """
+        Initialize telemetry (tracemalloc only runs while enabled)
+
+        Args:
+            enabled: Start tracing right away
+            snapshot_rate: Fraction of requests whose stages also record allocation sites
+            top_n: Allocation sites kept per stage snapshot / reported
+            frames: Stack frames stored per allocation
+        """
+        self.snapshot_rate = snapshot_rate
+        self.top_n = top_n
+        self.frames = frames
+        self.enabled = False
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.active_requests = 0
+        # Stages running outside any request, and how many have started so far
+        self.outside_stages = 0
+        self.outside_stage_runs = 0
+        self.requests: Dict[str, float] = {"count": 0, "overlapping": 0, "max_peak_bytes": 0, "total_peak_bytes": 0}
+        self.stages: Dict[str, dict] = {}
+        # "file:line" -> {"max_bytes", "hits", "stage"}
+        self.sites: Dict[str, dict] = {}
+
+        if enabled:
+            self.enable()
+
+    def enable(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.enabled = True
+        logger.info("Memory telemetry enabled (tracemalloc)")
+
+    def disable(self):
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _observe_peak(self):
+        """Fold the traced peak into this request's peak; reset it if we're alone"""
+        current, peak = tracemalloc.get_traced_memory()
+        state = self.local
+        state.peak = max(getattr(state, 'peak', 0), peak)
+        # Only the single in-flight request may reset - anyone else would wipe its peak
+        with self.lock:
+            alone = getattr(state, 'in_request', False) and self.active_requests == 1 and not self.outside_stages
+        if alone:
+            tracemalloc.reset_peak()
+        return current
+
+    def request(self):
+        """Context for one request"""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._tracked_request()
+
+    @contextmanager
+    def _tracked_request(self):
+        state = self.local
+        with self.lock:
+            self.active_requests += 1
+            overlapping = self.active_requests > 1 or self.outside_stages > 0
+            outside_runs = self.outside_stage_runs
+        state.in_request = True
+        state.snapshots = random.random() < self.snapshot_rate
+        start = self._observe_peak()
+        # Whatever peaked before this request started isn't this request's
+        state.peak = 0
+        try:
+            yield
+        finally:
+            state.peak = max(state.peak, tracemalloc.get_traced_memory()[1])
+            peak_delta = max(0, state.peak - start)
+            state.in_request = False
+            with self.lock:
+                self.active_requests -= 1
+                overlapping = (overlapping or self.active_requests > 0 or self.outside_stages > 0
+                               or self.outside_stage_runs != outside_runs)
+                self.requests["count"] += 1
+                self.requests["overlapping"] += int(overlapping)
+                self.requests["max_peak_bytes"] = max(self.requests["max_peak_bytes"], peak_delta)
+                self.requests["total_peak_bytes"] += peak_delta
+            state.snapshots = False
+
+    def stage(self, name: str, inner=_NULL_CONTEXT):
+        """Context recording one pipeline stage (wraps `inner`, e.g. a profiler stage)"""
+        if not self.enabled:
+            return inner
+        return self._tracked_stage(name, inner)
+
+    @contextmanager
+    def _tracked_stage(self, name: str, inner):
+        outside = not getattr(self.local, 'in_request', False)
+        if outside:
+            with self.lock:
+                self.outside_stages += 1
+                self.outside_stage_runs += 1
+        take_snapshots = getattr(self.local, 'snapshots', False)
+        before = tracemalloc.take_snapshot() if take_snapshots else None
+        start = self._observe_peak()
+        try:
+            with inner:
+                yield
+        finally:
+            if outside:
+                with self.lock:
+                    self.outside_stages -= 1
+            current, peak = tracemalloc.get_traced_memory()
+            self.local.peak = max(getattr(self.local, 'peak', 0), peak)
+            peak_delta = max(0, peak - start)
+            retained = current - start
+            with self.lock:
+                stats = self.stages.setdefault(name, {
+                    "count": 0, "max_peak_bytes": 0, "total_peak_bytes": 0, "max_retained_bytes": 0
+                })
+                stats["count"] += 1
+                stats["max_peak_bytes"] = max(stats["max_peak_bytes"], peak_delta)
+                stats["total_peak_bytes"] += peak_delta
+                stats["max_retained_bytes"] = max(stats["max_retained_bytes"], retained)
+            if before is not None:
+                self._record_sites(name, tracemalloc.take_snapshot().compare_to(before, 'lineno'))
+
+    def _record_sites(self, stage: str, diffs):
+        with self.lock:
+            for diff in diffs[:self.top_n]:
+                if diff.size_diff <= 0:
+                    continue
+                frame = diff.traceback[0]
+                key = f"{frame.filename}:{frame.lineno}"
+                site = self.sites.setdefault(key, {"max_bytes": 0, "hits": 0, "stage": stage})
+                site["max_bytes"] = max(site["max_bytes"], diff.size_diff)
+                site["hits"] += 1
+
+    def get_stats(self) -> dict:
+        """Per-request and per-stage peaks, largest allocation sites and RSS gauges"""
+        stats = {"enabled": self.enabled, "rss_bytes": rss_bytes(), "max_rss_bytes": max_rss_bytes()}
+        if tracemalloc.is_tracing():
+            stats["traced_current_bytes"], stats["traced_peak_bytes"] = tracemalloc.get_traced_memory()
+        with self.lock:
+            requests = dict(self.requests)
+            stages = {}
+            for name, stage in self.stages.items():
+                stages[name] = dict(stage, avg_peak_bytes=stage["total_peak_bytes"] / stage["count"])
+            sites = sorted(self.sites.items(), key=lambda item: -item[1]["max_bytes"])[:self.top_n]
+        if requests["count"]:
+            requests["avg_peak_bytes"] = requests["total_peak_bytes"] / requests["count"]
+        stats["requests"] = requests
+        stats["stages"] = stages
+        stats["top_allocation_sites"] = [dict(site, site=key) for key, site in sites]
+        return stats
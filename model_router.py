@@ -0,0 +1,233 @@
+"""
+Adaptive model selection
+A cheap local classifier sends trivial turns ("thanks", "what's 2+2") to a small fast
+model and keeps the large model for everything else. Decisions can be logged (features
+only, never message text) and replayed offline against different rules:
+
+    python model_router.py decisions.jsonl --rules rules.json
+"""
+
+import re
+import json
+import time
+import logging
+import argparse
+import threading
+from typing import Dict, Optional, Tuple
+
+from stats import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES = {
+    # Question types the small model may answer
+    "small_question_types": ["greeting", "thanks", "acknowledgement", "arithmetic"],
+    # Turns longer than this always use the large model
+    "max_small_chars": 160,
+    # Deep conversations keep the large model (user turns so far)
+    "max_small_depth": 3,
+    # Transcripts / OCR text go to the large model
+    "media_context_uses_large": True,
+}
+
+QUESTION_PATTERNS = [
+    # First: "hi, can you explain ..." / "thanks! now write ..." are complex, not small talk
+    ("complex", re.compile(
+        r"\b(explain|analy[sz]e|compare|summari[sz]e|translate|write|code|debug|why|how (do|does|can|would|should)|"
+        r"step[- ]by[- ]step|essay|plan|design|pros and cons)\b", re.I)),
+    ("greeting", re.compile(r"^(hi|hey|hello|yo|good (morning|afternoon|evening)|salam)\b[\s!.]*$", re.I)),
+    ("thanks", re.compile(r"^(thanks?|thank you|thx|ty|cheers|appreciate it)( (so|very) much| a lot)?[\s!.🙏😊]*$", re.I)),
+    ("acknowledgement", re.compile(r"^(ok(ay)?|cool|great|nice|got it|sure|yes|no|yep|nope|👍|🙏)[\s!.]*$", re.I)),
+    # At least one "<number> <operator> <number>" - not just "2024", "x" or "..."
+    ("arithmetic", re.compile(
+        r"^(?=.*\d\s*[+\-*/x×÷^%]\s*[\d(.])(what('?s| is)\s+)?[\d\s.+\-*/x×÷()^%=]+\??$", re.I)),
+]
+
+
+def load_rules(raw: Optional[str]) -> dict:
+    """Default rules, overridden by a JSON string or a path to a JSON file"""
+    rules = dict(DEFAULT_RULES)
+    if raw:
+        raw = raw.strip()
+        if not raw.startswith('{'):
+            with open(raw, encoding='utf-8') as f:
+                raw = f.read()
+        rules.update(json.loads(raw))
+    return rules
+
+
+# The assistant asked something or offered to do something - "yes" may mean real work
+OFFER_PATTERN = re.compile(
+    r"(\?\s*$|\b(want me to|would you like|shall i|should i|do you want|let me know if)\b)", re.I
+)
+
+
+def classify_question(message: str) -> str:
+    """Rough question type of a message"""
+    text = message.strip()
+    for name, pattern in QUESTION_PATTERNS:
+        if pattern.search(text):
+            return name
+    if len(text.split()) <= 12:
+        return "short_question"
+    return "general"
+
+
+def extract_features(message: str, context: Optional[list] = None, message_type: str = "text") -> dict:
+    """
+    Features the router decides on
+
+    Args:
+        message: User message (or transcript)
+        context: Conversation so far
+        message_type: text, audio or image - audio/image mean transcript/OCR context
+
+    Returns:
+        Feature dict (safe to log - contains no message text)
+    """
+    context = context or []
+    last_reply = next((item.get("content") or '' for item in reversed(context) if item.get("role") == "assistant"), '')
+    return {
+        "chars": len(message),
+        "words": len(message.split()),
+        "question_type": classify_question(message),
+        "depth": sum(1 for item in context if item.get("role") == "user"),
+        "media_context": message_type != "text",
+        "after_question": bool(OFFER_PATTERN.search(last_reply)),
+    }
+
+
+def decide(features: dict, rules: dict) -> Tuple[bool, str]:
+    """(use_small_model, reason) for a feature dict"""
+    if rules.get("media_context_uses_large", True) and features["media_context"]:
+        return False, "media_context"
+    if features["chars"] > rules["max_small_chars"]:
+        return False, "long_message"
+    if features["depth"] > rules["max_small_depth"]:
+        return False, "deep_conversation"
+    if features["question_type"] not in rules["small_question_types"]:
+        return False, f"question_type:{features['question_type']}"
+    # "yes" to "Want me to write the full code?" is a request for the code
+    if features["question_type"] == "acknowledgement" and features.get("after_question"):
+        return False, "acknowledgement_after_question"
+    return True, f"question_type:{features['question_type']}"
+
+
+class ModelRouter:
+    def __init__(self, small_model: str, large_model: str, rules: Optional[dict] = None,
+                 log_path: Optional[str] = None):
+        """
+        Initialize the router
+
+        Args:
+            small_model: Model for trivial turns
+            large_model: Model for everything else
+            rules: Routing rules (see DEFAULT_RULES)
+            log_path: Optional JSONL file to log decisions to for offline replay
+        """
+        self.small_model = small_model
+        self.large_model = large_model
+        self.rules = rules or dict(DEFAULT_RULES)
+        self.log_path = log_path
+
+        self.lock = threading.Lock()
+        self.latency = {small_model: LatencyWindow(), large_model: LatencyWindow()}
+        self.tokens = {small_model: 0, large_model: 0}
+        self.calls = {small_model: 0, large_model: 0}
+        self.reasons: Dict[str, int] = {}
+
+    def route(self, message: str, context: Optional[list] = None, message_type: str = "text") -> Tuple[str, dict]:
+        """
+        Pick the model for a chat turn
+
+        Returns:
+            (model name, decision record to pass to record())
+        """
+        features = extract_features(message, context, message_type)
+        use_small, reason = decide(features, self.rules)
+        model = self.small_model if use_small else self.large_model
+        with self.lock:
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        return model, {"ts": time.time(), "features": features, "model": model, "small": use_small, "reason": reason}
+
+    def record(self, decision: dict, latency_seconds: float, total_tokens: int = 0):
+        """Account for a finished call and append it to the decision log"""
+        model = decision["model"]
+        self.latency[model].add(latency_seconds)
+        with self.lock:
+            self.calls[model] += 1
+            self.tokens[model] += total_tokens or 0
+
+        if self.log_path:
+            entry = dict(decision, latency=round(latency_seconds, 4), tokens=total_tokens)
+            try:
+                with self.lock, open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry) + '\n')
+            except Exception as e:
+                logger.warning(f"Could not write routing log: {e}")
+
+    def get_stats(self) -> dict:
+        """Downgraded share plus latency/token savings estimated from per-model averages"""
+        with self.lock:
+            calls = dict(self.calls)
+            tokens = dict(self.tokens)
+            reasons = dict(self.reasons)
+        small, large = self.small_model, self.large_model
+        latency = {model: window.snapshot() for model, window in self.latency.items()}
+
+        total = calls[small] + calls[large]
+        avg_tokens = {model: tokens[model] / calls[model] if calls[model] else 0.0 for model in calls}
+        savings_known = calls[small] and calls[large]
+        return {
+            "calls": calls,
+            "downgraded_fraction": calls[small] / total if total else 0.0,
+            "latency_seconds": latency,
+            "avg_tokens": avg_tokens,
+            "reasons": reasons,
+            # What the downgraded turns would have cost on the large model
+            "estimated_latency_saved_seconds": (
+                calls[small] * (latency[large]["avg"] - latency[small]["avg"]) if savings_known else 0.0
+            ),
+            "estimated_tokens_saved": (
+                calls[small] * (avg_tokens[large] - avg_tokens[small]) if savings_known else 0.0
+            ),
+        }
+
+
+def replay(log_path: str, rules: dict) -> dict:
+    """
+    Re-run logged decisions against a set of rules
+
+    Args:
+        log_path: JSONL decision log written by ModelRouter
+        rules: Rules to evaluate
+
+    Returns:
+        How many turns would route small/large and how many decisions change
+    """
+    summary = {"turns": 0, "small": 0, "large": 0, "changed": 0, "upgraded": 0, "downgraded": 0}
+    with open(log_path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            use_small, _ = decide(entry["features"], rules)
+            summary["turns"] += 1
+            summary["small" if use_small else "large"] += 1
+            if use_small != entry["small"]:
+                summary["changed"] += 1
+                summary["downgraded" if use_small else "upgraded"] += 1
+    return summary
+
+
+def main():
+    """Replay a decision log against a rules file"""
+    parser = argparse.ArgumentParser(description="Replay logged routing decisions against new rules")
+    parser.add_argument("log", help="JSONL decision log (MODEL_ROUTING_LOG)")
+    parser.add_argument("--rules", help="Rules as JSON or a path to a JSON file")
+    args = parser.parse_args()
+    print(json.dumps(replay(args.log, load_rules(args.rules)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Micro-batching for Gemini OCR
+Images arriving within a short window (from one user or several) are sent in a single
+multi-image generate_content call and the per-image results (and an even share of
+the request's token usage) are split back out
+"""
+
+import json
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from stats import LatencyWindow
+from usage import gemini_usage
+
+logger = logging.getLogger(__name__)
+
+BATCH_INSTRUCTIONS = (
+    "You will receive {count} images, numbered 1 to {count} in the order given. "
+    "Handle each image separately and independently:\n{prompt}\n\n"
+    "Respond ONLY with a JSON array containing one object per image, in order: "
+    '[{{"image": 1, "result": "..."}}, ...]'
+)
+
+
+class OcrBatcher:
+    def __init__(self, model, prompt: str, window_seconds: float = 0.25, max_images: int = 4,
+                 max_payload_bytes: int = 8 * 1024 * 1024, max_parallel_batches: int = 2,
+                 on_request: Optional[Callable[[], None]] = None):
+        """
+        Initialize the batcher
+
+        Args:
+            model: Gemini GenerativeModel
+            prompt: Instructions applied to every image
+            window_seconds: How long the first image waits for company
+            max_images: Max images per request
+            max_payload_bytes: Max combined image size per request
+            max_parallel_batches: Batches in flight at once
+            on_request: Called before each Gemini request (connection telemetry)
+        """
+        self.model = model
+        self.prompt = prompt
+        self.window_seconds = window_seconds
+        self.max_images = max_images
+        self.max_payload_bytes = max_payload_bytes
+        self.on_request = on_request or (lambda: None)
+
+        self.condition = threading.Condition()
+        # (image, size_bytes, future, submitted_at)
+        self.pending: List[tuple] = []
+        self.pending_bytes = 0
+        self.batch_started: Optional[float] = None
+        self.executor = ThreadPoolExecutor(max_workers=max_parallel_batches, thread_name_prefix="ocr-batch")
+
+        self.image_latency = LatencyWindow()
+        self.stats = {"images": 0, "requests": 0, "batched_requests": 0, "fallback_requests": 0}
+
+        threading.Thread(target=self._collector, name="ocr-batcher", daemon=True).start()
+
+    def analyze(self, image, size_bytes: int) -> Tuple[str, dict]:
+        """
+        Queue an image (PIL) and wait for its analysis
+
+        Returns:
+            (analysis, token usage attributed to this image)
+        """
+        future = Future()
+        with self.condition:
+            # A big image that won't fit the current batch flushes it first
+            if self.pending and self.pending_bytes + size_bytes > self.max_payload_bytes:
+                self._flush()
+            self.pending.append((image, size_bytes, future, time.monotonic()))
+            self.pending_bytes += size_bytes
+            if self.batch_started is None:
+                self.batch_started = time.monotonic()
+            if len(self.pending) >= self.max_images:
+                self._flush()
+            self.condition.notify_all()
+        return future.result()
+
+    def _collector(self):
+        """Flush a batch once its window has elapsed"""
+        while True:
+            with self.condition:
+                while self.batch_started is None:
+                    self.condition.wait()
+                remaining = self.batch_started + self.window_seconds - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                self._flush()
+
+    def _flush(self):
+        """Hand the pending images to a worker (caller holds the condition)"""
+        batch = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        self.batch_started = None
+        if batch:
+            self.executor.submit(self._run, batch)
+
+    def _run(self, batch: List[tuple]):
+        try:
+            if len(batch) == 1:
+                results = [self._analyze_single(batch[0][0])]
+            else:
+                results = self._analyze_batch([item[0] for item in batch])
+            for (_, _, future, submitted_at), result in zip(batch, results):
+                future.set_result(result)
+                self.image_latency.add(time.monotonic() - submitted_at)
+        except Exception as e:
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _analyze_single(self, image) -> Tuple[str, dict]:
+        with self.condition:
+            self.stats["images"] += 1
+            self.stats["requests"] += 1
+        self.on_request()
+        response = self.model.generate_content([self.prompt, image])
+        return response.text, gemini_usage(response, [image])
+
+    def _analyze_batch(self, images: list) -> List[Tuple[str, dict]]:
+        """One request for several images; images missing from the answer are retried alone"""
+        with self.condition:
+            self.stats["images"] += len(images)
+            self.stats["requests"] += 1
+            self.stats["batched_requests"] += 1
+
+        instructions = BATCH_INSTRUCTIONS.format(count=len(images), prompt=self.prompt)
+        self.on_request()
+        response = self.model.generate_content(
+            [instructions] + images,
+            generation_config={"response_mime_type": "application/json"}
+        )
+
+        # Every image is charged an even share of the batched request
+        usage = gemini_usage(response, images)
+        share = {name: value // len(images) for name, value in usage.items()}
+
+        results: List[Optional[str]] = [None] * len(images)
+        try:
+            for item in json.loads(response.text):
+                index = int(item["image"]) - 1
+                if 0 <= index < len(images) and item.get("result"):
+                    results[index] = str(item["result"])
+        except Exception as e:
+            logger.warning(f"Could not parse batched OCR response: {e}")
+
+        analyses = []
+        for index, result in enumerate(results):
+            if result is None:
+                with self.condition:
+                    self.stats["images"] -= 1
+                    self.stats["fallback_requests"] += 1
+                result, single = self._analyze_single(images[index])
+                analyses.append((result, {name: share[name] + single[name] for name in share}))
+            else:
+                analyses.append((result, dict(share)))
+        return analyses
+
+    def get_stats(self) -> dict:
+        """Requests vs images sent to Gemini and per-image latency"""
+        with self.condition:
+            stats = dict(self.stats)
+            stats["pending"] = len(self.pending)
+        stats["images_per_request"] = stats["images"] / stats["requests"] if stats["requests"] else 0.0
+        stats["image_latency_seconds"] = self.image_latency.snapshot()
+        return stats
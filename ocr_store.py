@@ -0,0 +1,144 @@
+"""
+Per-user store of past OCR extractions and transcripts
+SQLite table + FTS5 inverted index, so "find that receipt from last week" is answered
+from the index in milliseconds instead of re-sending the image for OCR
+"""
+
+import re
+import time
+import sqlite3
+import logging
+import threading
+from typing import List, Optional
+
+from stats import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    job_id TEXT UNIQUE,
+    created REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS docs_user_created ON docs (user, created);
+CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(
+    text, content='docs', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS docs_ai AFTER INSERT ON docs BEGIN
+    INSERT INTO docs_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS docs_ad AFTER DELETE ON docs BEGIN
+    INSERT INTO docs_fts (docs_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+
+def build_match_query(terms: str) -> Optional[str]:
+    """Turn free text into an FTS5 query: every word must match (prefix match)"""
+    words = re.findall(r"\w+", terms.lower())
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+class OcrStore:
+    def __init__(self, path: str, max_docs_per_user: int = 500, retention_days: float = 90):
+        """
+        Open (or create) the store
+
+        Args:
+            path: SQLite file
+            max_docs_per_user: Oldest documents beyond this are dropped
+            retention_days: Documents older than this are dropped
+        """
+        self.max_docs_per_user = max_docs_per_user
+        self.retention_seconds = retention_days * 86400
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+        self.search_latency = LatencyWindow()
+        self.stats = {"added": 0, "searches": 0, "pruned": 0}
+        # Users who stopped sending media are only pruned here; search skips expired rows anyway
+        self.prune()
+
+    def add(self, user: str, kind: str, text: str, job_id: Optional[str] = None):
+        """
+        Index an extraction (a resumed job with the same job_id is only stored once)
+
+        Args:
+            user: Sender number
+            kind: image or audio
+            text: OCR output or transcript
+            job_id: Twilio MessageSid
+        """
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO docs (user, kind, job_id, created, text) VALUES (?, ?, ?, ?, ?)",
+                (user, kind, job_id, time.time(), text)
+            )
+            if cursor.rowcount:
+                self.stats["added"] += 1
+                self._prune_user(user)
+
+    def _prune_user(self, user: str):
+        cursor = self.db.execute(
+            """
+            DELETE FROM docs WHERE user = ? AND (created < ? OR id NOT IN (
+                SELECT id FROM docs WHERE user = ? ORDER BY created DESC LIMIT ?
+            ))
+            """,
+            (user, time.time() - self.retention_seconds, user, self.max_docs_per_user)
+        )
+        self.stats["pruned"] += cursor.rowcount
+
+    def prune(self):
+        """Apply the age limit to every user"""
+        with self.lock:
+            cursor = self.db.execute("DELETE FROM docs WHERE created < ?", (time.time() - self.retention_seconds,))
+            self.stats["pruned"] += cursor.rowcount
+
+    def search(self, user: str, terms: str, limit: int = 5) -> List[dict]:
+        """
+        Best matches among a user's documents
+
+        Returns:
+            [{"created", "kind", "snippet"}], best first
+        """
+        query = build_match_query(terms)
+        if query is None:
+            return []
+        started = time.perf_counter()
+        with self.lock:
+            rows = self.db.execute(
+                """
+                SELECT d.created, d.kind, snippet(docs_fts, 0, '*', '*', '…', 16)
+                FROM docs_fts JOIN docs d ON d.id = docs_fts.rowid
+                WHERE docs_fts MATCH ? AND d.user = ? AND d.created >= ?
+                ORDER BY bm25(docs_fts)
+                LIMIT ?
+                """,
+                (query, user, time.time() - self.retention_seconds, limit)
+            ).fetchall()
+            self.stats["searches"] += 1
+        self.search_latency.add(time.perf_counter() - started)
+        return [{"created": created, "kind": kind, "snippet": snippet} for created, kind, snippet in rows]
+
+    def get_stats(self) -> dict:
+        """Document counts, index size and search latency"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats["documents"] = self.db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+            stats["users"] = self.db.execute("SELECT COUNT(DISTINCT user) FROM docs").fetchone()[0]
+            page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+            stats["db_bytes"] = self.db.execute("PRAGMA page_count").fetchone()[0] * page_size
+            # FTS5 keeps its inverted index in the shadow table docs_fts_data
+            stats["index_bytes"] = self.db.execute("SELECT COALESCE(SUM(LENGTH(block)), 0) FROM docs_fts_data").fetchone()[0]
+        stats["search_seconds"] = self.search_latency.snapshot()
+        return stats
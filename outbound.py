@@ -0,0 +1,354 @@
+"""
+Outbound message dispatcher
+Paces sends per sender number (Twilio messages-per-second limit), delivers parts
+in order per recipient while different recipients go out in parallel, and
+retries 429 responses with backoff. InlineReply lets a webhook answer in its
+TwiML response instead when the reply is ready before a deadline.
+"""
+
+import time
+import logging
+import itertools
+import threading
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from twilio.base.exceptions import TwilioRestException
+
+from stats import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+# WhatsApp has a 1600 character limit (Twilio counts UTF-16 code units)
+MAX_MESSAGE_LENGTH = 1600
+# Room kept for the "[Part i/n]" prefix
+PART_PREFIX_RESERVE = 20
+
+
+def utf16_length(text: str) -> int:
+    """Length in UTF-16 code units (characters outside the BMP count twice)"""
+    return len(text) + sum(1 for ch in text if ord(ch) > 0xFFFF)
+
+
+def split_message(message: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Split a message into parts of at most `limit` UTF-16 code units
+
+    Cuts at the last whitespace before the limit (hard cut for very long words) and
+    never inside a surrogate pair. Runs in linear time: each character is scanned at
+    most twice, instead of re-slicing the remaining string on every split.
+
+    Args:
+        message: Text to send
+        limit: Max UTF-16 code units per part
+
+    Returns:
+        Message parts, in order
+    """
+    if utf16_length(message) <= limit:
+        return [message]
+
+    parts = []
+    length = len(message)
+    start = 0
+    while start < length:
+        # Parts never start with whitespace
+        while start < length and message[start].isspace():
+            start += 1
+        if start >= length:
+            break
+
+        units = 0
+        end = start
+        last_space = -1
+        while end < length:
+            width = 2 if ord(message[end]) > 0xFFFF else 1
+            if units + width > limit:
+                break
+            if message[end].isspace():
+                last_space = end
+            units += width
+            end += 1
+
+        if end < length and last_space > start:
+            end = last_space
+        part = message[start:end].rstrip()
+        if part:
+            parts.append(part)
+        start = end
+    return parts
+
+
+class PacingLimiter:
+    """Token bucket shared by every send from one sender number"""
+
+    def __init__(self, rate_per_second: float, burst: int = 1):
+        self.rate = rate_per_second
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a send is allowed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self, seconds: float):
+        """Push the bucket into debt after a 429 so every sender backs off"""
+        with self.lock:
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+class InlineReply:
+    """
+    Hand-off between a webhook waiting to answer inline (TwiML) and the REST send path
+
+    Replies offered before the webhook gives up are returned in its TwiML response;
+    anything offered after that has to go out through the REST API.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.closed = False
+        self.message: Optional[str] = None
+        self.created = time.monotonic()
+
+    def offer(self, message: str) -> bool:
+        """Claim a reply for the inline response; False means send it via REST"""
+        # Long replies need several messages - leave those to the dispatcher
+        if utf16_length(message) > MAX_MESSAGE_LENGTH:
+            return False
+        with self.lock:
+            if self.closed or self.message is not None:
+                return False
+            self.message = message
+        self.ready.set()
+        return True
+
+    def wait(self, deadline_seconds: float, done: Optional[Future] = None) -> Optional[str]:
+        """
+        Wait for a reply until the deadline (or until `done` finishes without one)
+
+        Returns:
+            Reply to put in the TwiML response, or None to answer empty
+        """
+        if done is not None:
+            # Stop waiting early if the job finished without offering anything
+            done.add_done_callback(lambda _: self.ready.set())
+        self.ready.wait(deadline_seconds)
+        with self.lock:
+            self.closed = True
+            return self.message
+
+
+class OutboundDispatcher:
+    def __init__(self, twilio_client, rate_per_second: float = 80.0, burst: int = 10,
+                 max_workers: int = 4, max_retries: int = 3, stage=None):
+        """
+        Initialize the dispatcher
+
+        Args:
+            twilio_client: Twilio REST client
+            rate_per_second: Messages per second allowed per sender number
+            burst: Sends allowed back to back before pacing kicks in
+            max_workers: Recipients served in parallel
+            max_retries: Retries for a part rejected with 429
+            stage: stage(name) -> context manager wrapped around each delivery (telemetry)
+        """
+        self.twilio_client = twilio_client
+        self.stage = stage or (lambda name: nullcontext())
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="outbound")
+
+        self.lock = threading.Lock()
+        self.limiters: Dict[str, PacingLimiter] = {}
+        # recipient -> queued (from, parts, future, enqueued_at); one drain task per recipient
+        self.queues: Dict[str, deque] = {}
+        # Parts of messages not fully delivered yet
+        self.queued_parts = 0
+        # Reply order per recipient: tickets in reservation order, and the messages
+        # (None = released without a message) submitted ahead of an earlier ticket
+        self.tickets = itertools.count()
+        self.order: Dict[str, deque] = {}
+        self.settled: Dict[int, Optional[tuple]] = {}
+
+        self.part_latency = LatencyWindow()
+        self.message_latency = LatencyWindow()
+        self.counters = {"messages": 0, "parts": 0, "retries_429": 0, "errors": 0}
+
+    def _limiter(self, from_number: str) -> PacingLimiter:
+        with self.lock:
+            if from_number not in self.limiters:
+                self.limiters[from_number] = PacingLimiter(self.rate_per_second, self.burst)
+            return self.limiters[from_number]
+
+    def reserve(self, to: str) -> int:
+        """
+        Hold a place in the recipient's reply order
+
+        Messages submitted with later tickets wait until this one is submitted or
+        released, so replies go out in the order their requests arrived even when
+        they finish out of order.
+
+        Returns:
+            Ticket for submit() / release()
+        """
+        with self.lock:
+            ticket = next(self.tickets)
+            self.order.setdefault(to, deque()).append(ticket)
+            return ticket
+
+    def release(self, to: str, ticket: int):
+        """Give up a reserved place without sending (no-op once the ticket is settled)"""
+        with self.lock:
+            if ticket in self.settled or ticket not in self.order.get(to, ()):
+                return
+            self.settled[ticket] = None
+            start_drain = self._advance(to)
+        if start_drain:
+            self.executor.submit(self._drain, to)
+
+    def submit(self, from_number: str, to: str, message: str, ticket: Optional[int] = None) -> Future:
+        """
+        Queue a message for delivery
+
+        Args:
+            from_number: Sender (Twilio WhatsApp number)
+            to: Recipient
+            message: Text, split into parts if too long
+            ticket: Place from reserve(); None queues behind everything reserved so far
+
+        Returns:
+            Future resolving to the same dict send_message always returned
+        """
+        if utf16_length(message) <= MAX_MESSAGE_LENGTH:
+            parts = [message]
+        else:
+            # Only split messages need room for the "[Part i/n]" prefix
+            parts = split_message(message, MAX_MESSAGE_LENGTH - PART_PREFIX_RESERVE)
+            parts = [f"[Part {i+1}/{len(parts)}]\n{part}" for i, part in enumerate(parts)]
+
+        future = Future()
+        with self.lock:
+            if ticket is None or ticket not in self.order.get(to, ()):
+                # Unreserved (or already released): join the back of the order
+                ticket = next(self.tickets)
+                self.order.setdefault(to, deque()).append(ticket)
+            self.queued_parts += len(parts)
+            self.settled[ticket] = (from_number, parts, future, time.monotonic())
+            start_drain = self._advance(to)
+        if start_drain:
+            self.executor.submit(self._drain, to)
+        return future
+
+    def _advance(self, to: str) -> bool:
+        """
+        Move settled tickets at the head of the recipient's order onto its queue
+        (caller holds the lock)
+
+        Returns:
+            True if the recipient needs a new drain task
+        """
+        order = self.order[to]
+        start_drain = False
+        while order and order[0] in self.settled:
+            entry = self.settled.pop(order.popleft())
+            if entry is None:
+                continue
+            queue = self.queues.get(to)
+            if queue is None:
+                queue = self.queues[to] = deque()
+                start_drain = True
+            queue.append(entry)
+        if not order:
+            del self.order[to]
+        return start_drain
+
+    def has_pending(self, to: str, ticket: Optional[int] = None) -> bool:
+        """
+        True while earlier messages to this recipient are queued or being delivered,
+        or (given a ticket) an earlier reserved reply hasn't been submitted yet
+        """
+        with self.lock:
+            if to in self.queues:
+                return True
+            return ticket is not None and self.order.get(to, deque([ticket]))[0] != ticket
+
+    def _drain(self, to: str):
+        """Deliver everything queued for one recipient, oldest first"""
+        while True:
+            with self.lock:
+                queue = self.queues[to]
+                if not queue:
+                    del self.queues[to]
+                    return
+                from_number, parts, future, enqueued_at = queue.popleft()
+            try:
+                with self.stage("send"):
+                    result = self._deliver(from_number, to, parts)
+                future.set_result(result)
+            except Exception as e:
+                logger.error(f"Error sending message: {e}")
+                with self.lock:
+                    self.counters["errors"] += 1
+                future.set_result({"status": "error", "error": str(e)})
+            finally:
+                self.message_latency.add(time.monotonic() - enqueued_at)
+                with self.lock:
+                    self.queued_parts -= len(parts)
+                    self.counters["messages"] += 1
+
+    def _deliver(self, from_number: str, to: str, parts: List[str]) -> dict:
+        limiter = self._limiter(from_number)
+        sids = []
+        for i, part in enumerate(parts):
+            for attempt in range(self.max_retries + 1):
+                limiter.acquire()
+                started = time.monotonic()
+                try:
+                    msg = self.twilio_client.messages.create(from_=from_number, body=part, to=to)
+                    break
+                except TwilioRestException as e:
+                    if e.status != 429 or attempt == self.max_retries:
+                        raise
+                    backoff = 2 ** attempt
+                    logger.warning(f"Twilio 429 for {to}, retrying part {i+1} in {backoff}s")
+                    limiter.penalize(backoff)
+                    with self.lock:
+                        self.counters["retries_429"] += 1
+                finally:
+                    self.part_latency.add(time.monotonic() - started)
+
+            with self.lock:
+                self.counters["parts"] += 1
+            sids.append(msg.sid)
+            logger.info(f"Message part {i+1}/{len(parts)} sent: {msg.sid}")
+
+        if len(sids) == 1:
+            return {"status": "sent", "sid": sids[0]}
+        return {"status": "sent", "sids": sids, "parts": len(sids)}
+
+    def get_stats(self) -> dict:
+        """Queue depth, send latency and counters"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["queue_depth_parts"] = self.queued_parts
+            stats["recipients_pending"] = len(self.queues)
+            stats["replies_reserved"] = sum(len(order) for order in self.order.values())
+        stats["part_send_seconds"] = self.part_latency.snapshot()
+        stats["message_delivery_seconds"] = self.message_latency.snapshot()
+        return stats
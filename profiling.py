@@ -0,0 +1,183 @@
+"""
+Opt-in request profiling
+A sampled fraction of requests is watched by a low-overhead sampling profiler (a
+background thread reading the request thread's stack every few milliseconds). Samples
+and wall time are attributed to pipeline stages (download, decode, ocr, transcription,
+llm, send) and aggregated as folded stacks for flame graphs.
+
+When profiling is off, request() and stage() return a shared no-op context manager.
+"""
+
+import sys
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+_NULL_CONTEXT = nullcontext()
+
+# Frames from these files are noise in the flame graph
+_SKIPPED_FILES = ('threading.py', 'thread.py', 'profiling.py', 'contextlib.py')
+
+
+class Profiler:
+    def __init__(self, sample_rate: float = 0.0, interval_seconds: float = 0.005, max_depth: int = 40):
+        """
+        Initialize the profiler (disabled until enable() or a sample rate > 0)
+
+        Args:
+            sample_rate: Fraction of requests to profile
+            interval_seconds: Time between stack samples
+            max_depth: Frames kept per sample
+        """
+        self.sample_rate = sample_rate
+        self.interval_seconds = interval_seconds
+        self.max_depth = max_depth
+        self.enabled = sample_rate > 0
+
+        self.lock = threading.Lock()
+        # thread id -> stack of stage names for requests being profiled
+        self.active: Dict[int, list] = {}
+        self.folded: Dict[str, int] = {}
+        self.stage_stats: Dict[str, dict] = {}
+        self.requests_profiled = 0
+        self.sampler = None
+        if self.enabled:
+            self._start_sampler()
+
+    def configure(self, enabled: bool = None, sample_rate: float = None, reset: bool = False):
+        """Switch profiling on/off or change the sample rate at runtime"""
+        with self.lock:
+            if sample_rate is not None:
+                self.sample_rate = max(0.0, min(1.0, sample_rate))
+            if enabled is not None:
+                self.enabled = enabled and self.sample_rate > 0
+            if reset:
+                self.folded = {}
+                self.stage_stats = {}
+                self.requests_profiled = 0
+        if self.enabled:
+            self._start_sampler()
+        logger.info(f"Profiling {'enabled' if self.enabled else 'disabled'} (sample rate {self.sample_rate})")
+
+    def _start_sampler(self):
+        with self.lock:
+            if self.sampler is not None and self.sampler.is_alive():
+                return
+            self.sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+            self.sampler.start()
+
+    def request(self):
+        """Context for one request; profiled with probability sample_rate"""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return _NULL_CONTEXT
+        return self._profiled_request()
+
+    @contextmanager
+    def _profiled_request(self):
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.active[thread_id] = ["other"]
+            self.requests_profiled += 1
+        try:
+            with self._profiled_stage(thread_id, "request"):
+                yield
+        finally:
+            with self.lock:
+                self.active.pop(thread_id, None)
+
+    def stage(self, name: str):
+        """Context attributing time spent inside it to a pipeline stage"""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        thread_id = threading.get_ident()
+        if thread_id not in self.active:
+            return _NULL_CONTEXT
+        return self._profiled_stage(thread_id, name)
+
+    @contextmanager
+    def _profiled_stage(self, thread_id: int, name: str):
+        stages = self.active.get(thread_id)
+        if stages is None:
+            yield
+            return
+        stages.append(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages.pop()
+            self._record_stage(name, time.perf_counter() - started)
+
+    def start_timer(self, name: str) -> Optional[Callable[[], None]]:
+        """
+        Time a stage that finishes on another thread (e.g. a queued send)
+
+        Returns:
+            Function to call when the work is done, or None if this request isn't profiled
+        """
+        if not self.enabled or threading.get_ident() not in self.active:
+            return None
+        started = time.perf_counter()
+        return lambda: self._record_stage(name, time.perf_counter() - started)
+
+    def _record_stage(self, name: str, elapsed: float):
+        with self.lock:
+            stats = self.stage_stats.setdefault(name, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            stats["count"] += 1
+            stats["total_seconds"] += elapsed
+            stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+
+    def _sample_loop(self):
+        while self.enabled:
+            time.sleep(self.interval_seconds)
+            with self.lock:
+                targets = {thread_id: stages[-1] for thread_id, stages in self.active.items()}
+            if not targets:
+                continue
+            frames = sys._current_frames()
+            samples = []
+            for thread_id, stage in targets.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples.append(self._fold(stage, frame))
+            with self.lock:
+                for key in samples:
+                    self.folded[key] = self.folded.get(key, 0) + 1
+
+    def _fold(self, stage: str, frame) -> str:
+        """"stage;outer_fn (file:line);...;inner_fn (file:line)" for one stack"""
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            filename = code.co_filename.rsplit('/', 1)[-1].rsplit('\\', 1)[-1]
+            if filename not in _SKIPPED_FILES:
+                names.append(f"{code.co_name} ({filename}:{frame.f_lineno})")
+            frame = frame.f_back
+        names.append(stage)
+        return ';'.join(reversed(names))
+
+    def folded_stacks(self) -> str:
+        """Aggregated samples in folded format (flamegraph.pl, speedscope)"""
+        with self.lock:
+            items = sorted(self.folded.items(), key=lambda item: -item[1])
+        return '\n'.join(f"{stack} {count}" for stack, count in items)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            by_stage: Dict[str, int] = {}
+            for stack, count in self.folded.items():
+                stage = stack.split(';', 1)[0]
+                by_stage[stage] = by_stage.get(stage, 0) + count
+            return {
+                "enabled": self.enabled,
+                "sample_rate": self.sample_rate,
+                "interval_seconds": self.interval_seconds,
+                "requests_profiled": self.requests_profiled,
+                "stages": {name: dict(stats) for name, stats in self.stage_stats.items()},
+                "samples_by_stage": by_stage,
+            }
@@ -0,0 +1,180 @@
+"""
+Response cache for stateless chat queries
+Exact match on normalized text, then cosine similarity over stored embeddings (NumPy)
+"""
+
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace"""
+    text = re.sub(r"[^\w\s]", ' ', text.lower())
+    return ' '.join(text.split())
+
+
+class ResponseCache:
+    def __init__(self, embed_fn: Optional[Callable[[str], List[float]]] = None,
+                 similarity_threshold: float = 0.92, ttl_seconds: float = 3600,
+                 capacity: int = 1000):
+        """
+        Initialize the cache
+
+        Args:
+            embed_fn: Returns an embedding vector for a text (None = exact matching only)
+            similarity_threshold: Minimum cosine similarity for a semantic hit
+            ttl_seconds: How long a cached response stays valid
+            capacity: Max number of cached responses (least recently used are evicted)
+        """
+        self.embed_fn = embed_fn
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.capacity = capacity
+
+        self.lock = threading.Lock()
+        # normalized text -> {"response", "created", "cost", "slot"}
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        # Unit-length embeddings, one row per slot; created lazily once the dimension is known
+        self.vectors: Optional[np.ndarray] = None
+        self.slot_keys: List[Optional[str]] = [None] * capacity
+        self.free_slots = list(range(capacity - 1, -1, -1))
+
+        self.stats = {
+            "lookups": 0,
+            "exact_hits": 0,
+            "semantic_hits": 0,
+            "misses": 0,
+            "embedding_errors": 0,
+            "latency_saved_seconds": 0.0,
+        }
+
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        if self.embed_fn is None:
+            return None
+        try:
+            vector = np.asarray(self.embed_fn(text), dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            return vector / norm if norm else None
+        except Exception as e:
+            logger.warning(f"Embedding failed, using exact matching only: {e}")
+            with self.lock:
+                self.stats["embedding_errors"] += 1
+            return None
+
+    def _is_expired(self, entry: dict, now: float) -> bool:
+        return now - entry["created"] > self.ttl_seconds
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key)
+        if entry["slot"] is not None:
+            self.vectors[entry["slot"]] = 0
+            self.slot_keys[entry["slot"]] = None
+            self.free_slots.append(entry["slot"])
+
+    def lookup(self, text: str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """
+        Find a cached response for a message
+
+        Args:
+            text: Incoming user message
+
+        Returns:
+            (cached response or None, embedding of the message to pass back to store())
+        """
+        key = normalize_text(text)
+        now = time.time()
+
+        with self.lock:
+            self.stats["lookups"] += 1
+            entry = self.entries.get(key)
+            if entry and self._is_expired(entry, now):
+                self._remove(key)
+                entry = None
+            if entry:
+                self.entries.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                self.stats["latency_saved_seconds"] += entry["cost"]
+                return entry["response"], None
+
+        # Embed outside the lock - it's a network call
+        vector = self._embed(key)
+        if vector is None:
+            with self.lock:
+                self.stats["misses"] += 1
+            return None, None
+
+        with self.lock:
+            if self.vectors is not None and len(self.entries):
+                scores = self.vectors @ vector
+                # Empty slots are zero rows and score 0
+                for slot in np.argsort(scores)[::-1]:
+                    if scores[slot] < self.similarity_threshold:
+                        break
+                    match = self.slot_keys[slot]
+                    if match is None:
+                        continue
+                    entry = self.entries[match]
+                    if self._is_expired(entry, now):
+                        self._remove(match)
+                        continue
+                    self.entries.move_to_end(match)
+                    self.stats["semantic_hits"] += 1
+                    self.stats["latency_saved_seconds"] += entry["cost"]
+                    return entry["response"], vector
+            self.stats["misses"] += 1
+        return None, vector
+
+    def store(self, text: str, response: str, cost_seconds: float = 0.0,
+              vector: Optional[np.ndarray] = None):
+        """
+        Cache a response
+
+        Args:
+            text: User message the response answers
+            response: AI response
+            cost_seconds: How long the response took to generate (reported as saved on hits)
+            vector: Embedding returned by lookup(), if any
+        """
+        key = normalize_text(text)
+        if not key or self.capacity <= 0:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            while len(self.entries) >= self.capacity:
+                # Evict the least recently used entry
+                self._remove(next(iter(self.entries)))
+
+            slot = None
+            if vector is not None:
+                if self.vectors is None:
+                    self.vectors = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+                if vector.shape[0] == self.vectors.shape[1]:
+                    slot = self.free_slots.pop()
+                    self.vectors[slot] = vector
+                    self.slot_keys[slot] = key
+
+            self.entries[key] = {
+                "response": response,
+                "created": time.time(),
+                "cost": cost_seconds,
+                "slot": slot,
+            }
+
+    def get_stats(self) -> Dict[str, float]:
+        """Counters plus hit rate and current size"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self.entries)
+        hits = stats["exact_hits"] + stats["semantic_hits"]
+        stats["hit_rate"] = hits / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
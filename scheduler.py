@@ -0,0 +1,189 @@
+"""
+Priority lanes for incoming messages
+Commands, text chat, audio and image jobs get their own queues and concurrency
+budgets so a burst of OCR work can't hold up one-line text replies. Jobs sharing a
+serial key (one sender) still run one at a time, in the order they were submitted.
+"""
+
+import json
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+from stats import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+# workers: threads whose home is this lane
+# max_concurrency: jobs from this lane running at once (including stolen workers)
+# weight: share of spare capacity under weighted fair sharing
+DEFAULT_LANES = {
+    "commands": {"workers": 1, "max_concurrency": 2, "weight": 4},
+    "text": {"workers": 3, "max_concurrency": 6, "weight": 4},
+    "audio": {"workers": 2, "max_concurrency": 3, "weight": 2},
+    "image": {"workers": 2, "max_concurrency": 3, "weight": 1},
+}
+
+
+def load_lane_config(raw: Optional[str]) -> Dict[str, dict]:
+    """Default lanes, with per-lane overrides from a JSON string (e.g. the LANES env var)"""
+    lanes = {name: dict(config) for name, config in DEFAULT_LANES.items()}
+    if raw:
+        for name, overrides in json.loads(raw).items():
+            lanes.setdefault(name, {"workers": 1, "max_concurrency": 1, "weight": 1}).update(overrides)
+    return lanes
+
+
+class Lane:
+    def __init__(self, name: str, workers: int, max_concurrency: int, weight: float):
+        self.name = name
+        self.workers = workers
+        self.max_concurrency = max(1, max_concurrency)
+        self.weight = max(weight, 0.001)
+        self.queue = deque()
+        self.running = 0
+        # Stride scheduling: the lane with the lowest pass value is served next
+        self.pass_value = 0.0
+        self.wait_latency = LatencyWindow()
+        self.run_latency = LatencyWindow()
+        self.completed = 0
+        self.stolen = 0
+
+    def has_capacity(self) -> bool:
+        return bool(self.queue) and self.running < self.max_concurrency
+
+
+class LaneScheduler:
+    def __init__(self, lanes: Dict[str, dict]):
+        """
+        Start the worker threads
+
+        Args:
+            lanes: name -> {"workers", "max_concurrency", "weight"}
+        """
+        self.lanes = {
+            name: Lane(name, config["workers"], config["max_concurrency"], config["weight"])
+            for name, config in lanes.items()
+        }
+        self.condition = threading.Condition()
+        self.virtual_time = 0.0
+        # serial key -> jobs held back until the key's running/queued job finishes
+        self.serial: Dict[str, deque] = {}
+
+        for lane in self.lanes.values():
+            for i in range(lane.workers):
+                threading.Thread(
+                    target=self._worker,
+                    args=(lane,),
+                    name=f"lane-{lane.name}-{i}",
+                    daemon=True
+                ).start()
+
+        logger.info("Lane scheduler started: " + ", ".join(
+            f"{lane.name}={lane.workers}w/{lane.max_concurrency}max" for lane in self.lanes.values()
+        ))
+
+    def submit(self, lane_name: str, fn, *args, serial_key: Optional[str] = None, **kwargs) -> Future:
+        """
+        Queue a job on a lane; returns a Future for its result
+
+        Jobs with the same serial_key (e.g. the sender's number) never overlap: each
+        one is released to its lane only after the previous one finished.
+        """
+        future = Future()
+        job = (self.lanes[lane_name], fn, args, kwargs, future, time.monotonic(), serial_key)
+        with self.condition:
+            if serial_key is not None:
+                held = self.serial.get(serial_key)
+                if held is not None:
+                    held.append(job)
+                    return future
+                self.serial[serial_key] = deque()
+            self._enqueue(job)
+        return future
+
+    def _enqueue(self, job: tuple):
+        """Put a job on its lane queue (caller holds the condition)"""
+        lane = job[0]
+        if not lane.queue:
+            # A lane coming back from idle doesn't get credit for the time it was idle
+            lane.pass_value = max(lane.pass_value, self.virtual_time)
+        lane.queue.append(job)
+        self.condition.notify_all()
+
+    def _release(self, serial_key: Optional[str]):
+        """Hand the key's next held job to its lane (caller holds the condition)"""
+        if serial_key is None:
+            return
+        held = self.serial[serial_key]
+        if held:
+            # Lane wait is measured from here - time held behind the key isn't lane queueing
+            job = held.popleft()
+            self._enqueue(job[:5] + (time.monotonic(),) + job[6:])
+        else:
+            del self.serial[serial_key]
+
+    def _pick(self, home: Lane) -> Optional[Lane]:
+        """Home lane first; otherwise steal from the lane furthest behind its fair share"""
+        if home.has_capacity():
+            return home
+        candidates = [lane for lane in self.lanes.values() if lane.has_capacity()]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda lane: lane.pass_value)
+
+    def _worker(self, home: Lane):
+        while True:
+            with self.condition:
+                lane = self._pick(home)
+                while lane is None:
+                    self.condition.wait()
+                    lane = self._pick(home)
+                _, fn, args, kwargs, future, enqueued_at, serial_key = lane.queue.popleft()
+                lane.running += 1
+                self.virtual_time = max(self.virtual_time, lane.pass_value)
+                lane.pass_value += 1 / lane.weight
+                if lane is not home:
+                    lane.stolen += 1
+
+            started = time.monotonic()
+            lane.wait_latency.add(started - enqueued_at)
+            try:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                logger.error(f"Job on lane {lane.name} failed: {e}", exc_info=True)
+                future.set_exception(e)
+            finally:
+                lane.run_latency.add(time.monotonic() - started)
+                with self.condition:
+                    lane.running -= 1
+                    lane.completed += 1
+                    self._release(serial_key)
+                    # A concurrency slot opened up - a capped lane may be runnable again
+                    self.condition.notify_all()
+
+    def get_stats(self) -> Dict[str, dict]:
+        """Per-lane queue depth, wait time and run time"""
+        stats = {}
+        with self.condition:
+            held = {}
+            for jobs in self.serial.values():
+                for job in jobs:
+                    held[job[0].name] = held.get(job[0].name, 0) + 1
+            for lane in self.lanes.values():
+                stats[lane.name] = {
+                    "queued": len(lane.queue),
+                    # Waiting for the same sender's previous message to finish
+                    "held": held.get(lane.name, 0),
+                    "running": lane.running,
+                    "completed": lane.completed,
+                    "stolen": lane.stolen,
+                }
+        for lane in self.lanes.values():
+            stats[lane.name]["queue_wait_seconds"] = lane.wait_latency.snapshot()
+            stats[lane.name]["run_seconds"] = lane.run_latency.snapshot()
+        return stats
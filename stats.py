@@ -0,0 +1,38 @@
+"""
+Small thread-safe helpers for the counters exposed on /metrics
+"""
+
+import threading
+from collections import deque
+from typing import Dict
+
+
+class LatencyWindow:
+    """Running count/total plus percentiles over the most recent samples"""
+
+    def __init__(self, size: int = 1000):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+
+    def snapshot(self) -> Dict[str, float]:
+        """count, avg, p50, p95 and max (seconds)"""
+        with self.lock:
+            ordered = sorted(self.samples)
+            count, total = self.count, self.total
+        if not ordered:
+            return {"count": count, "avg": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+        return {
+            "count": count,
+            "avg": total / count,
+            "p50": ordered[int(0.50 * (len(ordered) - 1))],
+            "p95": ordered[int(0.95 * (len(ordered) - 1))],
+            "max": ordered[-1],
+        }
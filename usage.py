@@ -0,0 +1,338 @@
+"""
+Token and cost accounting per user, provider, model and message type
+Every provider call records its usage (prompt / completion tokens, image tokens, audio
+seconds) and an estimated cost. Totals live in memory for /metrics and are flushed to a
+local SQLite store periodically; per-user daily quotas are checked before the next
+provider call and a daily budget raises alerts as it fills up.
+"""
+
+import json
+import math
+import time
+import atexit
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# List prices in USD: per 1M input/output tokens, or per hour of audio.
+# Groq and Gemini free tiers cost nothing, but this is what the traffic would cost on
+# the paid tier. Override or extend with USAGE_PRICES (JSON string or file path).
+DEFAULT_PRICES = {
+    "gpt-4o": {"input": 2.50, "output": 10.00},
+    "gpt-4o-mini": {"input": 0.15, "output": 0.60},
+    "whisper-1": {"audio_hour": 0.36},
+    "llama-3.3-70b-versatile": {"input": 0.59, "output": 0.79},
+    "llama-3.1-8b-instant": {"input": 0.05, "output": 0.08},
+    "whisper-large-v3": {"audio_hour": 0.111},
+    "gemini-2.5-flash": {"input": 0.30, "output": 2.50},
+}
+
+COUNTERS = ("calls", "prompt_tokens", "completion_tokens", "image_tokens", "audio_seconds", "cost")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    day TEXT,
+    user TEXT,
+    provider TEXT,
+    model TEXT,
+    message_type TEXT,
+    calls INTEGER,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    image_tokens INTEGER,
+    audio_seconds REAL,
+    cost REAL,
+    PRIMARY KEY (day, user, provider, model, message_type)
+);
+"""
+
+QUOTA_MESSAGE = "⚠️ You've reached today's usage limit. Please try again tomorrow."
+
+
+def load_prices(raw: Optional[str]) -> dict:
+    """Default prices, overridden by a JSON string or a path to a JSON file"""
+    prices = dict(DEFAULT_PRICES)
+    if raw:
+        raw = raw.strip()
+        if not raw.startswith('{'):
+            with open(raw, encoding='utf-8') as f:
+                raw = f.read()
+        prices.update(json.loads(raw))
+    return prices
+
+
+def openai_image_tokens(width: int, height: int) -> int:
+    """Input tokens for one image on gpt-4o (high detail: 85 + 170 per 512px tile)"""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def gemini_image_tokens(width: int, height: int) -> int:
+    """Input tokens for one image on Gemini 2.x (258 per 768px tile)"""
+    if width <= 384 and height <= 384:
+        return 258
+    return 258 * math.ceil(width / 768) * math.ceil(height / 768)
+
+
+def gemini_usage(response, images: Sequence = ()) -> dict:
+    """Token counts of a Gemini response; image tokens estimated if not reported"""
+    metadata = getattr(response, 'usage_metadata', None)
+    usage = {
+        "prompt_tokens": getattr(metadata, 'prompt_token_count', 0) or 0,
+        "completion_tokens": getattr(metadata, 'candidates_token_count', 0) or 0,
+        "image_tokens": 0,
+    }
+    for detail in getattr(metadata, 'prompt_tokens_details', None) or []:
+        if 'IMAGE' in str(getattr(detail, 'modality', '')):
+            usage["image_tokens"] += detail.token_count
+    if not usage["image_tokens"]:
+        usage["image_tokens"] = sum(gemini_image_tokens(*image.size) for image in images)
+    return usage
+
+
+def mask_user(user: str) -> str:
+    """Last digits only - /metrics is not the place for full phone numbers"""
+    return f"…{user[-4:]}" if len(user) > 4 else user
+
+
+class UsageTracker:
+    def __init__(self, store_path: Optional[str] = None, prices: Optional[dict] = None,
+                 flush_seconds: float = 60, user_daily_tokens: int = 0, user_daily_cost: float = 0.0,
+                 daily_budget: float = 0.0, alert_thresholds: Sequence[float] = (0.5, 0.8, 1.0),
+                 alert_fn: Optional[Callable[[str], None]] = None):
+        """
+        Initialize the tracker
+
+        Args:
+            store_path: SQLite file for the flushed totals (None = memory only)
+            prices: Model -> price entry (see DEFAULT_PRICES)
+            flush_seconds: How often pending totals are written to the store
+            user_daily_tokens: Tokens per user per day (0 = unlimited)
+            user_daily_cost: Estimated USD per user per day (0 = unlimited)
+            daily_budget: Estimated USD per day for everyone; alerts fire at each threshold (0 = off)
+            alert_thresholds: Fractions of daily_budget that trigger an alert
+            alert_fn: Called with the alert text (e.g. send it to an admin on WhatsApp)
+        """
+        self.prices = prices if prices is not None else dict(DEFAULT_PRICES)
+        self.flush_seconds = flush_seconds
+        self.user_daily_tokens = user_daily_tokens
+        self.user_daily_cost = user_daily_cost
+        self.daily_budget = daily_budget
+        self.alert_thresholds = sorted(alert_thresholds)
+        self.alert_fn = alert_fn
+
+        self.lock = threading.Lock()
+        # (user, provider, model, message_type) -> counters, since start / not yet flushed
+        self.totals: Dict[Tuple[str, str, str, str], dict] = {}
+        self.pending: Dict[Tuple[str, str, str, str, str], dict] = {}
+        self.day = self._today()
+        # user -> {"tokens", "cost"} for self.day (quotas)
+        self.user_today: Dict[str, dict] = {}
+        self.spent_today = 0.0
+        self.alerted: set = set()
+        self.stats = {"quota_rejections": 0, "alerts": 0, "flushes": 0, "flush_errors": 0}
+
+        self.db = None
+        if store_path:
+            self.db = sqlite3.connect(store_path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(SCHEMA)
+            self._load_today()
+            atexit.register(self.flush)
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+    def _load_today(self):
+        """Quotas survive a restart: start from what the store already has for today"""
+        rows = self.db.execute(
+            "SELECT user, SUM(prompt_tokens + completion_tokens), SUM(cost) FROM usage WHERE day = ? GROUP BY user",
+            (self.day,)
+        ).fetchall()
+        for user, tokens, cost in rows:
+            self.user_today[user] = {"tokens": tokens, "cost": cost}
+            self.spent_today += cost
+        self.alerted = {t for t in self.alert_thresholds if self.daily_budget and self.spent_today >= t * self.daily_budget}
+
+    def _roll_day(self):
+        """Reset the daily counters at UTC midnight (caller holds the lock)"""
+        today = self._today()
+        if today != self.day:
+            self.day = today
+            self.user_today = {}
+            self.spent_today = 0.0
+            self.alerted = set()
+
+    def estimate_cost(self, model: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+                      audio_seconds: float = 0.0) -> float:
+        """Estimated USD for one call (0 for models without a price)"""
+        price = self.prices.get(model, {})
+        return (
+            prompt_tokens * price.get("input", 0) / 1e6
+            + completion_tokens * price.get("output", 0) / 1e6
+            + audio_seconds * price.get("audio_hour", 0) / 3600
+        )
+
+    def check_quota(self, user: str) -> Optional[str]:
+        """
+        Call before spending provider quota on a user's message
+
+        Returns:
+            A reply for the user if they're over their daily quota, else None
+        """
+        if not (self.user_daily_tokens or self.user_daily_cost):
+            return None
+        with self.lock:
+            self._roll_day()
+            today = self.user_today.get(user)
+            over = today is not None and (
+                (self.user_daily_tokens and today["tokens"] >= self.user_daily_tokens)
+                or (self.user_daily_cost and today["cost"] >= self.user_daily_cost)
+            )
+            if over:
+                self.stats["quota_rejections"] += 1
+        if over:
+            logger.info(f"User {mask_user(user)} is over today's quota")
+            return QUOTA_MESSAGE
+        return None
+
+    def record(self, user: Optional[str], provider: str, model: str, message_type: str,
+               prompt_tokens: int = 0, completion_tokens: int = 0, image_tokens: int = 0,
+               audio_seconds: float = 0.0) -> float:
+        """
+        Account for one provider call (image tokens are part of prompt_tokens)
+
+        Returns:
+            Estimated cost in USD
+        """
+        user = user or "unknown"
+        cost = self.estimate_cost(model, prompt_tokens, completion_tokens, audio_seconds)
+        values = {
+            "calls": 1,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "image_tokens": image_tokens,
+            "audio_seconds": audio_seconds,
+            "cost": cost,
+        }
+        alerts = []
+        with self.lock:
+            self._roll_day()
+            key = (user, provider, model, message_type)
+            for target in (self.totals.setdefault(key, dict.fromkeys(COUNTERS, 0)),
+                           self.pending.setdefault((self.day,) + key, dict.fromkeys(COUNTERS, 0))):
+                for name, value in values.items():
+                    target[name] += value
+            today = self.user_today.setdefault(user, {"tokens": 0, "cost": 0.0})
+            today["tokens"] += prompt_tokens + completion_tokens
+            today["cost"] += cost
+            self.spent_today += cost
+            if self.daily_budget:
+                for threshold in self.alert_thresholds:
+                    if threshold not in self.alerted and self.spent_today >= threshold * self.daily_budget:
+                        self.alerted.add(threshold)
+                        self.stats["alerts"] += 1
+                        alerts.append(
+                            f"⚠️ Usage alert: ${self.spent_today:.2f} of the ${self.daily_budget:.2f} "
+                            f"daily budget spent ({threshold:.0%})"
+                        )
+        for alert in alerts:
+            logger.warning(alert)
+            if self.alert_fn:
+                try:
+                    self.alert_fn(alert)
+                except Exception as e:
+                    logger.error(f"Usage alert delivery failed: {e}")
+        return cost
+
+    def flush(self):
+        """Write pending totals to the store"""
+        if self.db is None:
+            return
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            with self.lock:
+                self.db.execute("BEGIN")
+                self.db.executemany(
+                    """
+                    INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (day, user, provider, model, message_type) DO UPDATE SET
+                        calls = calls + excluded.calls,
+                        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                        completion_tokens = completion_tokens + excluded.completion_tokens,
+                        image_tokens = image_tokens + excluded.image_tokens,
+                        audio_seconds = audio_seconds + excluded.audio_seconds,
+                        cost = cost + excluded.cost
+                    """,
+                    [key + tuple(counters[name] for name in COUNTERS) for key, counters in pending.items()]
+                )
+                self.db.execute("COMMIT")
+                self.stats["flushes"] += 1
+        except Exception as e:
+            logger.error(f"Usage flush failed: {e}")
+            with self.lock:
+                if self.db.in_transaction:
+                    self.db.execute("ROLLBACK")
+                self.stats["flush_errors"] += 1
+                # Keep the totals for the next attempt
+                for key, counters in pending.items():
+                    target = self.pending.setdefault(key, dict.fromkeys(COUNTERS, 0))
+                    for name in COUNTERS:
+                        target[name] += counters[name]
+
+    def start(self):
+        """Flush to the store in the background"""
+        if self.db is not None:
+            threading.Thread(target=self._flush_loop, name="usage-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def get_stats(self, top_users: int = 10) -> dict:
+        """Totals since start by provider / model / message type, top users and today's spend"""
+        with self.lock:
+            self._roll_day()
+            totals = {key: dict(counters) for key, counters in self.totals.items()}
+            today = {
+                "day": self.day,
+                "estimated_cost": self.spent_today,
+                "daily_budget": self.daily_budget or None,
+                "alerts_fired": sorted(self.alerted),
+            }
+            stats = dict(self.stats)
+
+        def group(index: int) -> Dict[str, dict]:
+            grouped: Dict[str, dict] = {}
+            for key, counters in totals.items():
+                target = grouped.setdefault(key[index], dict.fromkeys(COUNTERS, 0))
+                for name in COUNTERS:
+                    target[name] += counters[name]
+            return grouped
+
+        by_user = sorted(group(0).items(), key=lambda item: -item[1]["cost"])[:top_users]
+        stats.update({
+            "total": {name: sum(c[name] for c in totals.values()) for name in COUNTERS},
+            "by_provider": group(1),
+            "by_model": group(2),
+            "by_message_type": group(3),
+            # Ranked list: two numbers can share their last digits, so masks aren't keys
+            "top_users": [
+                dict(counters, rank=rank, user=mask_user(user))
+                for rank, (user, counters) in enumerate(by_user, 1)
+            ],
+            "today": today,
+        })
+        return stats
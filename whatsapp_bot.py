@@ -5,6 +5,8 @@ Uses Twilio for WhatsApp and OpenAI Whisper for AI interactions
 
 import os
 import logging
+import threading
+import time
 from pathlib import Path
 from typing import Optional, Dict
 import asyncio
@@ -12,16 +14,21 @@ import asyncio
 # Twilio for WhatsApp
 from flask import Flask, request
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 from twilio.twiml.messaging_response import MessagingResponse
-import requests
 
 # AI and processing libraries
 from openai import OpenAI
-from pydub import AudioSegment
 from PIL import Image
 import io
 import base64
 
+from audio_utils import transcode_for_upload
+from model_router import ModelRouter, load_rules
+from connections import ConnectionManager
+from memory_telemetry import MemoryTelemetry
+from usage import UsageTracker, load_prices, openai_image_tokens
+
 # Configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -41,8 +48,22 @@ class WhatsAppBot:
             twilio_auth_token: Twilio Auth Token
             twilio_phone_number: Twilio WhatsApp number (e.g., whatsapp:+14155238886)
         """
-        self.openai_client = OpenAI(api_key=openai_api_key)
-        self.twilio_client = Client(twilio_account_sid, twilio_auth_token)
+        # Pooled, pre-warmed connections to OpenAI and Twilio
+        self.connections = ConnectionManager(
+            keepalive_interval=float(os.getenv('KEEPALIVE_INTERVAL_SECONDS', 240))
+        )
+        
+        self.openai_client = OpenAI(
+            api_key=openai_api_key,
+            http_client=self.connections.httpx_client(
+                "openai", os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+            )
+        )
+        twilio_http = TwilioHttpClient(pool_connections=True)
+        self.twilio_session = self.connections.requests_session(
+            "twilio", os.getenv('TWILIO_BASE_URL', 'https://api.twilio.com'), twilio_http.session
+        )
+        self.twilio_client = Client(twilio_account_sid, twilio_auth_token, http_client=twilio_http)
         self.twilio_phone_number = twilio_phone_number
         
         # Create upload folder if it doesn't exist
@@ -51,6 +72,47 @@ class WhatsAppBot:
         # Store conversation context (simple in-memory storage)
         self.conversation_contexts: Dict[str, list] = {}
         
+        # Opt-in routing of trivial turns to a small model (rules: MODEL_ROUTING_RULES)
+        self.model_router = None
+        if os.getenv('MODEL_ROUTING_ENABLED', 'false').lower() == 'true':
+            self.model_router = ModelRouter(
+                small_model=os.getenv('SMALL_CHAT_MODEL', 'gpt-4o-mini'),
+                large_model="gpt-4o",
+                rules=load_rules(os.getenv('MODEL_ROUTING_RULES')),
+                log_path=os.getenv('MODEL_ROUTING_LOG')
+            )
+        
+        # Opt-in per-request / per-stage allocation tracking (tracemalloc)
+        self.memory = MemoryTelemetry(
+            enabled=os.getenv('MEMORY_TELEMETRY', 'false').lower() == 'true',
+            snapshot_rate=float(os.getenv('MEMORY_SNAPSHOT_RATE', 0.1))
+        )
+        
+        # Upload size / latency counters exposed on /metrics
+        self.stats_lock = threading.Lock()
+        self.audio_stats = {
+            "transcriptions": 0,
+            "input_bytes": 0,
+            "uploaded_bytes": 0,
+            "transcode_seconds": 0.0,
+            "transcribe_seconds": 0.0,
+        }
+        
+        # Token / cost accounting, per-user daily quotas and budget alerts
+        self.usage_alert_number = os.getenv('USAGE_ALERT_NUMBER')
+        self.usage = UsageTracker(
+            store_path=os.getenv('USAGE_STORE_PATH', f"{UPLOAD_FOLDER}/usage.db"),
+            prices=load_prices(os.getenv('USAGE_PRICES')),
+            flush_seconds=float(os.getenv('USAGE_FLUSH_SECONDS', 60)),
+            user_daily_tokens=int(os.getenv('USAGE_USER_DAILY_TOKENS', 0)),
+            user_daily_cost=float(os.getenv('USAGE_USER_DAILY_COST', 0)),
+            daily_budget=float(os.getenv('USAGE_DAILY_BUDGET', 0)),
+            alert_fn=self._send_usage_alert
+        )
+        
+        self.connections.start()
+        self.usage.start()
+        
         logger.info("WhatsApp Bot initialized with Twilio")
     
     def send_message(self, to: str, message: str) -> dict:
@@ -67,56 +129,69 @@ class WhatsAppBot:
             logger.error(f"Error sending message: {e}")
             return {"status": "error", "error": str(e)}
     
+    def _send_usage_alert(self, alert: str):
+        """Budget alerts go to the admin number, if one is configured"""
+        if self.usage_alert_number:
+            self.send_message(self.usage_alert_number, alert)
+    
     def download_media(self, media_url: str) -> Optional[bytes]:
         """Download media from Twilio"""
         try:
             # Twilio media URLs require authentication
-            response = requests.get(
-                media_url,
-                auth=(self.twilio_client.username, self.twilio_client.password)
-            )
+            with self.memory.stage("download"):
+                response = self.twilio_session.get(
+                    media_url,
+                    auth=(self.twilio_client.username, self.twilio_client.password)
+                )
             response.raise_for_status()
             return response.content
         except Exception as e:
             logger.error(f"Error downloading media: {e}")
             return None
     
-    def process_audio(self, audio_data: bytes, audio_format: str = 'ogg') -> str:
+    def process_audio(self, audio_data: bytes, audio_format: str = 'ogg', user_number: str = None) -> str:
         """
         Convert audio to text using speech recognition
         
         Args:
             audio_data: Raw audio bytes
             audio_format: Audio format (ogg, mp3, wav, etc.)
+            user_number: Sender, for usage accounting
         
         Returns:
             Transcribed text
         """
         try:
-            # Save audio temporarily
-            temp_audio_path = f"{UPLOAD_FOLDER}/temp_audio.{audio_format}"
-            with open(temp_audio_path, 'wb') as f:
-                f.write(audio_data)
-            
-            # Convert to WAV if needed
-            if audio_format != 'wav':
-                audio = AudioSegment.from_file(temp_audio_path, format=audio_format)
-                wav_path = f"{UPLOAD_FOLDER}/temp_audio.wav"
-                audio.export(wav_path, format='wav')
-                temp_audio_path = wav_path
+            # Keep compressed audio compressed - only WAV/AMR/etc. get transcoded (in memory)
+            started = time.monotonic()
+            with self.memory.stage("decode"):
+                upload_data, upload_format = transcode_for_upload(audio_data, audio_format)
+            transcoded = time.monotonic()
             
             # Use OpenAI Whisper for transcription (more accurate)
-            with open(temp_audio_path, 'rb') as audio_file:
-                transcript = self.openai_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    language="en"  # Remove this to auto-detect language
-                )
+            transcript = self.openai_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=(f"audio.{upload_format}", upload_data),
+                language="en",  # Remove this to auto-detect language
+                response_format="verbose_json"  # includes the billed duration
+            )
+            finished = time.monotonic()
+            self.usage.record(
+                user_number, "openai", "whisper-1", "audio",
+                audio_seconds=float(getattr(transcript, 'duration', 0) or 0)
+            )
             
-            # Clean up
-            os.remove(temp_audio_path)
-            if audio_format != 'wav' and os.path.exists(f"{UPLOAD_FOLDER}/temp_audio.wav"):
-                os.remove(f"{UPLOAD_FOLDER}/temp_audio.wav")
+            self._record_audio_upload(
+                input_bytes=len(audio_data),
+                upload_bytes=len(upload_data),
+                transcode_seconds=transcoded - started,
+                transcribe_seconds=finished - transcoded
+            )
+            logger.info(
+                f"Transcribed {audio_format} audio: {len(audio_data)} bytes in, "
+                f"{len(upload_data)} bytes uploaded as {upload_format} "
+                f"(transcode {transcoded - started:.2f}s, whisper {finished - transcoded:.2f}s)"
+            )
             
             return transcript.text
         
@@ -124,39 +199,85 @@ class WhatsAppBot:
             logger.error(f"Error processing audio: {e}")
             return f"Error transcribing audio: {str(e)}"
     
-    def process_image(self, image_data: bytes, user_query: str = "What's in this image?") -> str:
+    def _record_audio_upload(self, input_bytes: int, upload_bytes: int,
+                             transcode_seconds: float, transcribe_seconds: float):
+        """Accumulate upload size and latency totals for /metrics"""
+        with self.stats_lock:
+            stats = self.audio_stats
+            stats["transcriptions"] += 1
+            stats["input_bytes"] += input_bytes
+            stats["uploaded_bytes"] += upload_bytes
+            stats["transcode_seconds"] += transcode_seconds
+            stats["transcribe_seconds"] += transcribe_seconds
+    
+    def get_metrics(self) -> dict:
+        """Snapshot of the bot's counters"""
+        with self.stats_lock:
+            audio = dict(self.audio_stats)
+        count = audio["transcriptions"] or 1
+        audio["avg_input_bytes"] = audio["input_bytes"] / count
+        audio["avg_uploaded_bytes"] = audio["uploaded_bytes"] / count
+        audio["avg_transcode_seconds"] = audio["transcode_seconds"] / count
+        audio["avg_transcribe_seconds"] = audio["transcribe_seconds"] / count
+        metrics = {
+            "audio": audio,
+            "connections": self.connections.get_stats(),
+            "memory": self.memory.get_stats(),
+            "usage": self.usage.get_stats(),
+        }
+        if self.model_router:
+            metrics["model_routing"] = self.model_router.get_stats()
+        return metrics
+    
+    def process_image(self, image_data: bytes, user_query: str = "What's in this image?",
+                      user_number: str = None) -> str:
         """
         Analyze image using OpenAI Vision
         
         Args:
             image_data: Raw image bytes
             user_query: Question about the image
+            user_number: Sender, for usage accounting
         
         Returns:
             AI description of the image
         """
         try:
             # Encode image to base64
-            base64_image = base64.b64encode(image_data).decode('utf-8')
+            with self.memory.stage("encode"):
+                base64_image = base64.b64encode(image_data).decode('utf-8')
             
             # Use GPT-4 Vision
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o",  # or "gpt-4-vision-preview"
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": user_query},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
+            with self.memory.stage("vision"):
+                response = self.openai_client.chat.completions.create(
+                    model="gpt-4o",  # or "gpt-4-vision-preview"
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": user_query},
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": f"data:image/jpeg;base64,{base64_image}"
+                                    }
                                 }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=500
+                            ]
+                        }
+                    ],
+                    max_tokens=500
+                )
+            
+            # Image tokens are billed as prompt tokens; the split is estimated from the size
+            try:
+                image_tokens = openai_image_tokens(*Image.open(io.BytesIO(image_data)).size)
+            except Exception:
+                image_tokens = 0
+            self.usage.record(
+                user_number, "openai", "gpt-4o", "image",
+                prompt_tokens=response.usage.prompt_tokens,
+                completion_tokens=response.usage.completion_tokens,
+                image_tokens=image_tokens
             )
             
             return response.choices[0].message.content
@@ -165,7 +286,8 @@ class WhatsAppBot:
             logger.error(f"Error processing image: {e}")
             return f"Error analyzing image: {str(e)}"
     
-    def chat_with_ai(self, message: str, user_number: str = None, context: list = None) -> str:
+    def chat_with_ai(self, message: str, user_number: str = None, context: list = None,
+                            message_type: str = "text") -> str:
         """
         Have a conversation with AI
         
@@ -173,6 +295,7 @@ class WhatsAppBot:
             message: User message
             user_number: User's phone number for context tracking
             context: Previous conversation context
+            message_type: text, or audio/image when the message is a transcript/OCR output
         
         Returns:
             AI response
@@ -194,8 +317,15 @@ class WhatsAppBot:
             # Add user message
             messages = context + [{"role": "user", "content": message}]
             
+            # Trivial turns can go to the small model
+            model = "gpt-4o"
+            decision = None
+            if self.model_router:
+                model, decision = self.model_router.route(message, context, message_type)
+            
+            started = time.monotonic()
             response = self.openai_client.chat.completions.create(
-                model="gpt-4o",
+                model=model,
                 messages=messages,
                 max_tokens=500,
                 temperature=0.7
@@ -203,6 +333,14 @@ class WhatsAppBot:
             
             ai_response = response.choices[0].message.content
             
+            if decision:
+                self.model_router.record(decision, time.monotonic() - started, response.usage.total_tokens)
+            self.usage.record(
+                user_number, "openai", model, message_type,
+                prompt_tokens=response.usage.prompt_tokens,
+                completion_tokens=response.usage.completion_tokens
+            )
+            
             # Update conversation context (keep last 10 messages)
             if user_number:
                 new_context = messages + [{"role": "assistant", "content": ai_response}]
@@ -252,12 +390,18 @@ class WhatsAppBot:
                     return response
                 
                 else:
-                    response = self.chat_with_ai(body, from_number)
+                    # Over quota: refuse before spending any provider tokens
+                    response = self.usage.check_quota(from_number) or self.chat_with_ai(body, from_number)
                     self.send_message(from_number, response)
                     return response
             
             # Handle media messages
             elif num_media > 0 and media_url:
+                refusal = self.usage.check_quota(from_number)
+                if refusal:
+                    self.send_message(from_number, refusal)
+                    return refusal
+                
                 # Download media
                 media_data = self.download_media(media_url)
                 
@@ -273,10 +417,10 @@ class WhatsAppBot:
                     if audio_format == 'mpeg':
                         audio_format = 'mp3'
                     
-                    transcription = self.process_audio(media_data, audio_format)
+                    transcription = self.process_audio(media_data, audio_format, from_number)
                     
                     response = f"🎤 *Transcription:*\n{transcription}\n\n💬 *AI Response:*\n"
-                    ai_response = self.chat_with_ai(transcription, from_number)
+                    ai_response = self.chat_with_ai(transcription, from_number, message_type="audio")
                     full_response = response + ai_response
                     
                     self.send_message(from_number, full_response)
@@ -285,7 +429,7 @@ class WhatsAppBot:
                 # Handle images
                 elif media_content_type and 'image' in media_content_type:
                     query = body if body else "Describe this image in detail"
-                    description = self.process_image(media_data, query)
+                    description = self.process_image(media_data, query, from_number)
                     
                     response = f"🖼️ *Image Analysis:*\n{description}"
                     self.send_message(from_number, response)
@@ -331,13 +475,14 @@ def webhook():
         logger.info(f"Webhook received from {from_number}: {body} (Media: {num_media})")
         
         # Process message (bot will send response itself)
-        bot.handle_message(
-            from_number=from_number,
-            body=body,
-            media_url=media_url,
-            media_content_type=media_content_type,
-            num_media=num_media
-        )
+        with bot.memory.request():
+            bot.handle_message(
+                from_number=from_number,
+                body=body,
+                media_url=media_url,
+                media_content_type=media_content_type,
+                num_media=num_media
+            )
         
         # Return empty response (message already sent)
         resp = MessagingResponse()
@@ -354,6 +499,11 @@ def health():
     """Health check endpoint"""
     return {"status": "healthy", "service": "whatsapp-bot"}, 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Bot counters (upload sizes, latencies, usage and cost)"""
+    return bot.get_metrics(), 200
+
 
 def main():
     """Initialize and run the bot"""
@@ -10,18 +10,38 @@ from typing import Optional, Dict
 import asyncio
 import base64
 import io
+import time
+import hmac
+import threading
+from datetime import datetime
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 # Twilio for WhatsApp
 from flask import Flask, request
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 from twilio.twiml.messaging_response import MessagingResponse
-import requests
 
 # Free AI alternatives
 import groq  # Free LLM API
 import google.generativeai as genai  # Google Gemini for images
 from PIL import Image
 
+from audio_utils import prepare_chunks, merge_transcripts, transcode_for_upload
+from response_cache import ResponseCache
+from outbound import OutboundDispatcher, InlineReply
+from scheduler import LaneScheduler, load_lane_config
+from cluster import ClusterRouter, parse_nodes
+from ocr_batcher import OcrBatcher
+from model_router import ModelRouter, load_rules
+from connections import ConnectionManager
+from job_journal import JobJournal, DOWNLOADED, TRANSCRIBED, OCR, ANSWERED, SENT
+from profiling import Profiler
+from memory_telemetry import MemoryTelemetry
+from ocr_store import OcrStore
+from usage import UsageTracker, load_prices, gemini_usage
+
 # Configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -29,6 +49,28 @@ logger = logging.getLogger(__name__)
 # Constants
 UPLOAD_FOLDER = 'downloads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp3', 'wav', 'ogg', 'opus', 'mpeg', 'amr'}
+START_COMMANDS = ['/start', 'start', 'hello', 'hi']
+RESET_COMMANDS = ['/reset', 'reset']
+SEARCH_COMMAND = '/search'
+OCR_HEADER = "📄 *Text & Info:*\n\n"
+
+# Retries for a chunk rejected with 429 (one rate-limited chunk shouldn't lose the transcript)
+TRANSCRIBE_MAX_RETRIES = 3
+
+# Focused prompt for concise OCR output
+OCR_PROMPT = (
+    "Extract ALL text from this image in a clear format. "
+    "Then provide ONE brief sentence describing what type of document/image this is. "
+    "Be concise and direct. No extra explanations."
+)
+
+class FailedResult(str):
+    """Text for the user describing a failed stage - sent, but never journaled or indexed"""
+
+
+def is_search_command(body: str) -> bool:
+    """Whether a text message is the /search command (with or without search words)"""
+    return body.lower().split(maxsplit=1)[:1] == [SEARCH_COMMAND]
 
 class WhatsAppBotFree:
     def __init__(self, groq_api_key: str, gemini_api_key: str, twilio_account_sid: str, twilio_auth_token: str, twilio_phone_number: str):
@@ -42,159 +84,385 @@ class WhatsAppBotFree:
             twilio_auth_token: Twilio Auth Token
             twilio_phone_number: Twilio WhatsApp number
         """
-        self.groq_client = groq.Groq(api_key=groq_api_key)
+        # Create upload folder if it doesn't exist
+        Path(UPLOAD_FOLDER).mkdir(exist_ok=True)
+        
+        # Pooled, pre-warmed connections to every backend
+        self.connections = ConnectionManager(
+            keepalive_interval=float(os.getenv('KEEPALIVE_INTERVAL_SECONDS', 240))
+        )
+        
+        self.groq_client = groq.Groq(
+            api_key=groq_api_key,
+            http_client=self.connections.httpx_client("groq", os.getenv('GROQ_BASE_URL', 'https://api.groq.com'))
+        )
         
         # Initialize Gemini for image analysis
         genai.configure(api_key=gemini_api_key)
         self.gemini_model = genai.GenerativeModel('gemini-2.5-flash')
+        # count_tokens goes through the model's own client, so it warms the generate_content connection
+        self.gemini_backend = self.connections.register_ping("gemini", lambda: self.gemini_model.count_tokens("ping"))
+        
+        # Images arriving close together share one Gemini request (0 ms window = off)
+        self.ocr_batcher = None
+        ocr_batch_window_ms = int(os.getenv('OCR_BATCH_WINDOW_MS', 250))
+        if ocr_batch_window_ms > 0:
+            self.ocr_batcher = OcrBatcher(
+                self.gemini_model,
+                OCR_PROMPT,
+                window_seconds=ocr_batch_window_ms / 1000,
+                max_images=int(os.getenv('OCR_BATCH_MAX_IMAGES', 4)),
+                max_payload_bytes=int(os.getenv('OCR_BATCH_MAX_BYTES', 8 * 1024 * 1024)),
+                on_request=self.gemini_backend.touch
+            )
         
-        self.twilio_client = Client(twilio_account_sid, twilio_auth_token)
+        twilio_http = TwilioHttpClient(pool_connections=True)
+        self.twilio_session = self.connections.requests_session(
+            "twilio", os.getenv('TWILIO_BASE_URL', 'https://api.twilio.com'), twilio_http.session
+        )
+        self.twilio_client = Client(twilio_account_sid, twilio_auth_token, http_client=twilio_http)
         self.twilio_phone_number = twilio_phone_number
         
-        # Create upload folder if it doesn't exist
-        Path(UPLOAD_FOLDER).mkdir(exist_ok=True)
+        # Webhook waits this long to answer inline (TwiML) before falling back to REST; 0 = always REST
+        self.inline_reply_deadline = float(os.getenv('INLINE_REPLY_DEADLINE_SECONDS', 0))
+        
+        # Multi-node mode: each sender number is owned by one node (consistent hashing)
+        self.cluster = None
+        cluster_nodes = parse_nodes(os.getenv('CLUSTER_NODES'))
+        if cluster_nodes:
+            node_id = os.getenv('NODE_ID')
+            if node_id not in cluster_nodes:
+                raise ValueError("NODE_ID must be one of the nodes listed in CLUSTER_NODES")
+            if not os.getenv('CLUSTER_SECRET'):
+                raise ValueError("CLUSTER_SECRET is required when CLUSTER_NODES is set")
+            self.cluster = ClusterRouter(node_id, cluster_nodes, secret=os.getenv('CLUSTER_SECRET'))
+        
+        # Opt-in sampling profiler (toggle at runtime via /debug/profile)
+        self.profiler = Profiler(sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', 0)))
+        
+        # Opt-in per-request / per-stage allocation tracking (tracemalloc)
+        self.memory = MemoryTelemetry(
+            enabled=os.getenv('MEMORY_TELEMETRY', 'false').lower() == 'true',
+            snapshot_rate=float(os.getenv('MEMORY_SNAPSHOT_RATE', 0.1))
+        )
+        
+        # Incoming messages run on priority lanes (commands / text / audio / image)
+        self.scheduler = LaneScheduler(load_lane_config(os.getenv('LANES')))
+        
+        # Durable journal of finished stages, so restarts don't re-run paid AI calls
+        self.journal = None
+        if os.getenv('JOB_JOURNAL_ENABLED', 'true').lower() == 'true':
+            self.journal = JobJournal(
+                os.getenv('JOB_JOURNAL_PATH', f"{UPLOAD_FOLDER}/jobs.db"),
+                retention_hours=float(os.getenv('JOB_JOURNAL_RETENTION_HOURS', 24))
+            )
+        
+        # Searchable history of each user's OCR results and transcripts (/search)
+        self.ocr_store = None
+        if os.getenv('OCR_STORE_ENABLED', 'true').lower() == 'true':
+            self.ocr_store = OcrStore(
+                os.getenv('OCR_STORE_PATH', f"{UPLOAD_FOLDER}/ocr_store.db"),
+                max_docs_per_user=int(os.getenv('OCR_STORE_MAX_DOCS_PER_USER', 500)),
+                retention_days=float(os.getenv('OCR_STORE_RETENTION_DAYS', 90))
+            )
+        
+        # Token / cost accounting, per-user daily quotas and budget alerts
+        self.usage_alert_number = os.getenv('USAGE_ALERT_NUMBER')
+        self.usage = UsageTracker(
+            store_path=os.getenv('USAGE_STORE_PATH', f"{UPLOAD_FOLDER}/usage.db"),
+            prices=load_prices(os.getenv('USAGE_PRICES')),
+            flush_seconds=float(os.getenv('USAGE_FLUSH_SECONDS', 60)),
+            user_daily_tokens=int(os.getenv('USAGE_USER_DAILY_TOKENS', 0)),
+            user_daily_cost=float(os.getenv('USAGE_USER_DAILY_COST', 0)),
+            daily_budget=float(os.getenv('USAGE_DAILY_BUDGET', 0)),
+            alert_fn=self._send_usage_alert
+        )
+        self.stats_lock = threading.Lock()
+        self.reply_stats = {"inline": 0, "rest": 0, "inline_ready_seconds": 0.0}
+        # Upload size / latency counters exposed on /metrics
+        self.audio_stats = {
+            "transcriptions": 0,
+            "chunked": 0,
+            "input_bytes": 0,
+            "uploaded_bytes": 0,
+            "transcode_seconds": 0.0,
+            "transcribe_seconds": 0.0,
+        }
+        
+        # Outbound sends are paced against Twilio's messages-per-second limit
+        # (80 MPS is Twilio's default WhatsApp sender throughput)
+        self.outbound = OutboundDispatcher(
+            self.twilio_client,
+            rate_per_second=float(os.getenv('TWILIO_MESSAGES_PER_SECOND', 80)),
+            burst=int(os.getenv('TWILIO_SEND_BURST', 10)),
+            max_workers=int(os.getenv('OUTBOUND_WORKERS', 4)),
+            stage=self.memory.stage
+        )
         
         # Store conversation context (simple in-memory storage)
         self.conversation_contexts: Dict[str, list] = {}
+        self.context_locks: Dict[str, threading.Lock] = {}
+        self.context_locks_guard = threading.Lock()
+        
+        # Long voice notes are chunked and transcribed in parallel
+        self.audio_chunk_min_seconds = int(os.getenv('AUDIO_CHUNK_MIN_SECONDS', 120))
+        self.audio_chunk_min_bytes = int(os.getenv('AUDIO_CHUNK_MIN_BYTES', 256 * 1024))
+        self.audio_chunk_seconds = int(os.getenv('AUDIO_CHUNK_SECONDS', 60))
+        self.audio_chunk_overlap_ms = int(os.getenv('AUDIO_CHUNK_OVERLAP_MS', 1500))
+        self.transcribe_max_parallel = int(os.getenv('TRANSCRIBE_MAX_PARALLEL', 4))
+        
+        # Opt-in routing of trivial turns to a small model (rules: MODEL_ROUTING_RULES)
+        self.model_router = None
+        if os.getenv('MODEL_ROUTING_ENABLED', 'false').lower() == 'true':
+            self.model_router = ModelRouter(
+                small_model=os.getenv('SMALL_CHAT_MODEL', 'llama-3.1-8b-instant'),
+                large_model="llama-3.3-70b-versatile",
+                rules=load_rules(os.getenv('MODEL_ROUTING_RULES')),
+                log_path=os.getenv('MODEL_ROUTING_LOG')
+            )
+        
+        # Opt-in cache for first-turn questions ("what are your hours", ...)
+        self.response_cache = None
+        if os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true':
+            self.response_cache = ResponseCache(
+                embed_fn=self._embed_text,
+                similarity_threshold=float(os.getenv('RESPONSE_CACHE_THRESHOLD', 0.92)),
+                ttl_seconds=float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', 3600)),
+                capacity=int(os.getenv('RESPONSE_CACHE_CAPACITY', 1000))
+            )
+        
+        self.connections.start()
+        self.usage.start()
+        
+        if self.journal:
+            # Heartbeat + resume jobs left unfinished by a crashed/restarted worker
+            threading.Thread(
+                target=self.journal.run_maintenance,
+                args=(self._resume_job,),
+                name="job-journal",
+                daemon=True
+            ).start()
         
         logger.info("WhatsApp Bot initialized with FREE AI models (Groq + Gemini)")
     
-    def send_message(self, to: str, message: str) -> dict:
-        """Send a text message via Twilio WhatsApp (splits if too long)"""
+    def send_message(self, to: str, message: str, ticket: Optional[int] = None) -> dict:
+        """Queue a text message for Twilio WhatsApp delivery (split into parts if too long)"""
         try:
-            # WhatsApp has 1600 character limit - split if needed
-            MAX_LENGTH = 1600
-            
-            if len(message) <= MAX_LENGTH:
-                # Send single message
-                msg = self.twilio_client.messages.create(
-                    from_=self.twilio_phone_number,
-                    body=message,
-                    to=to
-                )
-                logger.info(f"Message sent: {msg.sid}")
-                return {"status": "sent", "sid": msg.sid}
-            else:
-                # Split into multiple messages
-                parts = []
-                while len(message) > 0:
-                    if len(message) <= MAX_LENGTH:
-                        parts.append(message)
-                        break
-                    else:
-                        # Find last space before limit to avoid cutting words
-                        split_at = message.rfind(' ', 0, MAX_LENGTH)
-                        if split_at == -1:
-                            split_at = MAX_LENGTH
-                        parts.append(message[:split_at])
-                        message = message[split_at:].strip()
-                
-                # Send all parts
-                sids = []
-                for i, part in enumerate(parts):
-                    prefix = f"[Part {i+1}/{len(parts)}]\n" if len(parts) > 1 else ""
-                    msg = self.twilio_client.messages.create(
-                        from_=self.twilio_phone_number,
-                        body=prefix + part,
-                        to=to
-                    )
-                    sids.append(msg.sid)
-                    logger.info(f"Message part {i+1}/{len(parts)} sent: {msg.sid}")
-                
-                return {"status": "sent", "sids": sids, "parts": len(parts)}
-                
+            # Paced per sender number; parts keep their order per recipient, replies
+            # keep the order of their tickets
+            future = self.outbound.submit(self.twilio_phone_number, to, message, ticket)
+            return {"status": "queued", "future": future}
         except Exception as e:
             logger.error(f"Error sending message: {e}")
             return {"status": "error", "error": str(e)}
     
+    def _reply(self, to: str, reply: Optional[InlineReply], message: str, job_id: str = None,
+               ticket: Optional[int] = None):
+        """Answer inline in the webhook's TwiML if it's still waiting, otherwise via REST"""
+        # An inline answer would overtake earlier replies still queued for this recipient
+        if reply is not None and not self.outbound.has_pending(to, ticket) and reply.offer(message):
+            with self.stats_lock:
+                self.reply_stats["inline"] += 1
+                self.reply_stats["inline_ready_seconds"] += time.monotonic() - reply.created
+            if ticket is not None:
+                self.outbound.release(to, ticket)
+            if self.journal and job_id:
+                self.journal.record(job_id, SENT)
+            return
+        with self.stats_lock:
+            self.reply_stats["rest"] += 1
+        # Delivery happens on the dispatcher's threads: the profiler times it until the
+        # Future resolves, memory telemetry wraps the delivery itself
+        finish_send = self.profiler.start_timer("send")
+        result = self.send_message(to, message, ticket)
+        if finish_send and "future" in result:
+            result["future"].add_done_callback(lambda _: finish_send())
+        
+        if self.journal and job_id and "future" in result:
+            def mark_sent(future):
+                if future.result().get("status") == "sent":
+                    self.journal.record(job_id, SENT)
+            result["future"].add_done_callback(mark_sent)
+    
+    def _journaled(self, job_id: Optional[str], stage: str, run):
+        """Run a pipeline stage, or reuse its output if the journal already has it"""
+        if self.journal and job_id:
+            output = self.journal.get_stage(job_id, stage)
+            if output is not None:
+                return output
+        output = run()
+        # Failed stages return None or a FailedResult - those are retried, not journaled
+        if self.journal and job_id and output and not isinstance(output, FailedResult):
+            self.journal.record(job_id, stage, output)
+        return output
+    
     def download_media(self, media_url: str) -> Optional[bytes]:
         """Download media from Twilio"""
         try:
-            response = requests.get(
-                media_url,
-                auth=(self.twilio_client.username, self.twilio_client.password)
-            )
+            # Same keep-alive session as the Twilio client
+            with self._stage("download"):
+                response = self.twilio_session.get(
+                    media_url,
+                    auth=(self.twilio_client.username, self.twilio_client.password)
+                )
             response.raise_for_status()
             return response.content
         except Exception as e:
             logger.error(f"Error downloading media: {e}")
             return None
     
-    def process_audio_free(self, audio_data: bytes, audio_format: str = 'ogg') -> str:
+    def process_audio_free(self, audio_data: bytes, audio_format: str = 'ogg', user_number: str = None) -> str:
         """
         Convert audio to text using Groq's Whisper (FREE!)
         
+        Long voice notes are split at pauses and the chunks are transcribed in parallel.
+        
         Args:
             audio_data: Raw audio bytes
             audio_format: Audio format (ogg, mp3, wav, etc.)
+            user_number: Sender, for usage accounting
         
         Returns:
             Transcribed text
         """
         try:
-            # Save audio temporarily - Groq supports ogg, mp3, wav, m4a, flac directly
-            temp_audio_path = f"{UPLOAD_FOLDER}/temp_audio.{audio_format}"
-            with open(temp_audio_path, 'wb') as f:
-                f.write(audio_data)
+            started = time.monotonic()
+            
+            # Only notes longer than the threshold are worth decoding and chunking
+            chunked = None
+            if len(audio_data) > self.audio_chunk_min_bytes:
+                with self._stage("decode"):
+                    chunked = prepare_chunks(
+                        audio_data,
+                        audio_format,
+                        min_duration_ms=self.audio_chunk_min_seconds * 1000,
+                        chunk_ms=self.audio_chunk_seconds * 1000,
+                        overlap_ms=self.audio_chunk_overlap_ms
+                    )
             
-            # Use Groq's Whisper for transcription (FREE!)
-            # Groq Whisper supports: flac, mp3, mp4, mpeg, mpga, m4a, ogg, wav, webm
-            with open(temp_audio_path, 'rb') as audio_file:
-                transcription = self.groq_client.audio.transcriptions.create(
-                    file=(f"audio.{audio_format}", audio_file, f"audio/{audio_format}"),
-                    model="whisper-large-v3",  # Free on Groq!
-                    response_format="text"
+            if chunked is None:
+                # Groq takes ogg, mp3, m4a, flac directly - WAV/AMR get compressed first
+                with self._stage("decode"):
+                    upload_data, upload_format = transcode_for_upload(audio_data, audio_format)
+                transcoded = time.monotonic()
+                with self._stage("transcription"):
+                    transcription = self._transcribe(upload_data, upload_format, user_number)
+                finished = time.monotonic()
+                self._record_audio_upload(len(audio_data), len(upload_data), transcoded - started, finished - transcoded)
+                logger.info(
+                    f"Transcribed {len(audio_data)} bytes ({len(upload_data)} uploaded as {upload_format}) "
+                    f"in {finished - started:.2f}s"
                 )
+                return transcription
             
-            # Clean up
-            if os.path.exists(temp_audio_path):
-                os.remove(temp_audio_path)
+            chunks, duration_ms = chunked
+            transcoded = time.monotonic()
+            upload_bytes = sum(len(chunk) for chunk, _ in chunks)
+            workers = min(self.transcribe_max_parallel, len(chunks))
+            with self._stage("transcription"), ThreadPoolExecutor(max_workers=workers) as executor:
+                # map() keeps the results in chunk order
+                parts = list(executor.map(lambda chunk: self._transcribe_chunk(chunk, user_number), chunks))
+            finished = time.monotonic()
             
-            return transcription
+            self._record_audio_upload(
+                len(audio_data), upload_bytes, transcoded - started, finished - transcoded, chunked=True
+            )
+            logger.info(
+                f"Transcribed {duration_ms / 1000:.0f}s of audio as {len(chunks)} chunks "
+                f"({workers} in parallel): {len(audio_data)} bytes in, {upload_bytes} bytes uploaded "
+                f"in {finished - started:.2f}s"
+            )
+            return merge_transcripts(parts)
         
         except Exception as e:
             logger.error(f"Error processing audio: {e}")
-            return f"Error transcribing audio: {str(e)}"
+            return FailedResult(f"Error transcribing audio: {str(e)}")
+    
+    def _record_audio_upload(self, input_bytes: int, upload_bytes: int, transcode_seconds: float,
+                             transcribe_seconds: float, chunked: bool = False):
+        """Accumulate upload size and latency totals for /metrics"""
+        with self.stats_lock:
+            stats = self.audio_stats
+            stats["transcriptions"] += 1
+            stats["chunked"] += int(chunked)
+            stats["input_bytes"] += input_bytes
+            stats["uploaded_bytes"] += upload_bytes
+            stats["transcode_seconds"] += transcode_seconds
+            stats["transcribe_seconds"] += transcribe_seconds
     
-    def process_image_free(self, image_data: bytes, user_query: str = "What's in this image?") -> str:
+    def _transcribe_chunk(self, chunk: tuple, user_number: str = None) -> str:
+        """Transcribe one (data, format) chunk, backing off and retrying on 429"""
+        audio_data, audio_format = chunk
+        for attempt in range(TRANSCRIBE_MAX_RETRIES + 1):
+            try:
+                return self._transcribe(audio_data, audio_format, user_number)
+            except groq.RateLimitError as e:
+                if attempt == TRANSCRIBE_MAX_RETRIES:
+                    raise
+                retry_after = e.response.headers.get('retry-after') if e.response is not None else None
+                try:
+                    backoff = float(retry_after)
+                except (TypeError, ValueError):
+                    backoff = 2 ** attempt
+                logger.warning(f"Groq 429 on an audio chunk, retrying in {backoff:.1f}s")
+                time.sleep(backoff)
+    
+    def _transcribe(self, audio_data: bytes, audio_format: str, user_number: str = None) -> str:
+        """Send one audio file to Groq's Whisper (in memory, no temp files)"""
+        # Groq Whisper supports: flac, mp3, mp4, mpeg, mpga, m4a, ogg, wav, webm
+        result = self.groq_client.audio.transcriptions.create(
+            file=(f"audio.{audio_format}", audio_data, f"audio/{audio_format}"),
+            model="whisper-large-v3",  # Free on Groq!
+            response_format="verbose_json"  # includes the billed duration
+        )
+        self.usage.record(
+            user_number, "groq", "whisper-large-v3", "audio",
+            audio_seconds=float(getattr(result, 'duration', 0) or 0)
+        )
+        return result.text.strip()
+    
+    def process_image_free(self, image_data: bytes, user_query: str = "What's in this image?",
+                           user_number: str = None) -> str:
         """
         Analyze image using HuggingFace's FREE BLIP model (online, no local install)
         
         Args:
             image_data: Raw image bytes
             user_query: Question about the image
+            user_number: Sender, for usage accounting
         
         Returns:
             Description of the image
         """
         try:
             # Get basic image info
-            image = Image.open(io.BytesIO(image_data))
+            with self._stage("decode"):
+                image = Image.open(io.BytesIO(image_data))
             width, height = image.size
             mode = image.mode
             format_name = image.format or "Unknown"
             
             # Use Google Gemini 2.5 Flash for image analysis (FREE!)
             try:
-                # Create a focused prompt for concise output
-                focused_prompt = (
-                    "Extract ALL text from this image in a clear format. "
-                    "Then provide ONE brief sentence describing what type of document/image this is. "
-                    "Be concise and direct. No extra explanations."
-                )
-                
                 # Gemini can work directly with PIL Image
-                response = self.gemini_model.generate_content([focused_prompt, image])
-                
-                analysis = response.text
+                with self._stage("ocr"):
+                    if self.ocr_batcher:
+                        # Shares one request with other images arriving around the same time
+                        analysis, usage = self.ocr_batcher.analyze(image, len(image_data))
+                    else:
+                        self.gemini_backend.touch()
+                        response = self.gemini_model.generate_content([OCR_PROMPT, image])
+                        analysis = response.text
+                        usage = gemini_usage(response, [image])
+                self.usage.record(user_number, "gemini", "gemini-2.5-flash", "image", **usage)
                 
-                return f"📄 *Text & Info:*\n\n{analysis}"
+                return f"{OCR_HEADER}{analysis}"
                     
             except Exception as vision_error:
                 logger.warning(f"Image analysis error: {vision_error}")
                 
                 # Fallback: Basic info + error message
-                return (
+                return FailedResult(
                     f"📸 *Image Received!*\n\n"
                     f"📏 Size: {width} x {height}\n"
                     f"📦 Format: {format_name}\n\n"
@@ -204,9 +472,10 @@ class WhatsAppBotFree:
         
         except Exception as e:
             logger.error(f"Error processing image: {e}")
-            return f"Error analyzing image: {str(e)}"
+            return FailedResult(f"Error analyzing image: {str(e)}")
     
-    def chat_with_ai_free(self, message: str, user_number: str = None, context: list = None) -> str:
+    def chat_with_ai_free(self, message: str, user_number: str = None, context: list = None,
+                                 message_type: str = "text") -> str:
         """
         Chat using FREE Groq API (Llama 3 or Mixtral)
         
@@ -214,86 +483,267 @@ class WhatsAppBotFree:
             message: User message
             user_number: User's phone number for context tracking
             context: Previous conversation context
+            message_type: text, or audio/image when the message is a transcript/OCR output
         
         Returns:
             AI response
         """
-        try:
-            # Get or create conversation context
-            if context is None and user_number:
-                context = self.conversation_contexts.get(user_number, [])
-            elif context is None:
-                context = []
+        # Messages from one user can be answered concurrently (different lanes); the
+        # history read -> call -> write must not interleave or one turn is lost
+        with self._context_lock(user_number):
+            try:
+                # Get or create conversation context
+                if context is None and user_number:
+                    context = self.conversation_contexts.get(user_number, [])
+                elif context is None:
+                    context = []
             
-            # Add system message if context is empty
-            if not context:
-                context = [{
-                    "role": "system",
-                    "content": "You are a professional AI assistant. Provide direct, concise answers focused on the task at hand. No unnecessary information about what models you use or being free. Just do the work."
-                }]
+                # Add system message if context is empty
+                first_turn = not context
+                if first_turn:
+                    context = [{
+                        "role": "system",
+                        "content": "You are a professional AI assistant. Provide direct, concise answers focused on the task at hand. No unnecessary information about what models you use or being free. Just do the work."
+                    }]
             
-            # Add user message
-            messages = context + [{"role": "user", "content": message}]
+                # Add user message
+                messages = context + [{"role": "user", "content": message}]
             
-            # Use Groq's FREE API with Llama 3
-            response = self.groq_client.chat.completions.create(
-                model="llama-3.3-70b-versatile",  # Free and fast!
-                messages=messages,
-                max_tokens=500,
-                temperature=0.7
-            )
+                # First-turn answers don't depend on history, so they can be shared
+                ai_response = None
+                query_vector = None
+                if first_turn and self.response_cache:
+                    ai_response, query_vector = self.response_cache.lookup(message)
             
-            ai_response = response.choices[0].message.content
+                if ai_response is None:
+                    # Trivial turns can go to the small model
+                    model = "llama-3.3-70b-versatile"  # Free and fast!
+                    decision = None
+                    if self.model_router:
+                        model, decision = self.model_router.route(message, context, message_type)
+                
+                    started = time.monotonic()
+                
+                    # Use Groq's FREE API with Llama 3
+                    with self._stage("llm"):
+                        response = self.groq_client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            max_tokens=500,
+                            temperature=0.7
+                        )
+                
+                    ai_response = response.choices[0].message.content
+                
+                    if decision:
+                        self.model_router.record(decision, time.monotonic() - started, response.usage.total_tokens)
+                    self.usage.record(
+                        user_number, "groq", model, message_type,
+                        prompt_tokens=response.usage.prompt_tokens,
+                        completion_tokens=response.usage.completion_tokens
+                    )
+                
+                    if first_turn and self.response_cache:
+                        self.response_cache.store(message, ai_response, time.monotonic() - started, query_vector)
             
-            # Update conversation context (keep last 10 messages)
-            if user_number:
-                new_context = messages + [{"role": "assistant", "content": ai_response}]
-                self.conversation_contexts[user_number] = new_context[-10:]
+                # Update conversation context (keep last 10 messages)
+                if user_number:
+                    new_context = messages + [{"role": "assistant", "content": ai_response}]
+                    self.conversation_contexts[user_number] = new_context[-10:]
             
-            return ai_response
+                return ai_response
+        
+            except Exception as e:
+                logger.error(f"Error in AI chat: {e}")
+                return FailedResult(f"Error communicating with AI: {str(e)}")
+    
+    def _embed_text(self, text: str) -> list:
+        """Embedding for the response cache (Gemini, free tier)"""
+        result = genai.embed_content(model="models/text-embedding-004", content=text)
+        return result["embedding"]
+    
+    def _send_usage_alert(self, alert: str):
+        """Budget alerts go to the admin number, if one is configured"""
+        if self.usage_alert_number:
+            self.send_message(self.usage_alert_number, alert)
+    
+    def get_metrics(self) -> dict:
+        """Snapshot of the bot's counters"""
+        outbound = self.outbound.get_stats()
+        with self.stats_lock:
+            replies = dict(self.reply_stats)
+            audio = dict(self.audio_stats)
+        count = audio["transcriptions"] or 1
+        audio["avg_input_bytes"] = audio["input_bytes"] / count
+        audio["avg_uploaded_bytes"] = audio["uploaded_bytes"] / count
+        audio["avg_transcode_seconds"] = audio["transcode_seconds"] / count
+        audio["avg_transcribe_seconds"] = audio["transcribe_seconds"] / count
+        total = replies["inline"] + replies["rest"]
+        replies["inline_ratio"] = replies["inline"] / total if total else 0.0
+        # Each inline reply skips one messages.create round trip (and one billable request)
+        replies["estimated_latency_saved_seconds"] = replies["inline"] * outbound["part_send_seconds"]["avg"]
         
+        metrics = {
+            "outbound": outbound,
+            "replies": replies,
+            "audio": audio,
+            "lanes": self.scheduler.get_stats(),
+            "connections": self.connections.get_stats(),
+            "memory": self.memory.get_stats(),
+            "usage": self.usage.get_stats(),
+        }
+        if self.cluster:
+            metrics["cluster"] = self.cluster.get_stats()
+        if self.ocr_batcher:
+            metrics["ocr_batching"] = self.ocr_batcher.get_stats()
+        if self.model_router:
+            metrics["model_routing"] = self.model_router.get_stats()
+        if self.journal:
+            metrics["job_journal"] = self.journal.get_stats()
+        if self.response_cache:
+            metrics["response_cache"] = self.response_cache.get_stats()
+        if self.ocr_store:
+            metrics["ocr_store"] = self.ocr_store.get_stats()
+        return metrics
+    
+    def classify_lane(self, body: str = None, media_content_type: str = None, num_media: int = 0) -> str:
+        """Pick the scheduler lane for an incoming message"""
+        if num_media > 0:
+            if media_content_type and 'audio' in media_content_type:
+                return "audio"
+            if media_content_type and 'image' in media_content_type:
+                return "image"
+            return "commands"  # unsupported media - instant error reply
+        if body and body.lower() in START_COMMANDS + RESET_COMMANDS:
+            return "commands"
+        if body and is_search_command(body):
+            return "commands"  # answered from the local index
+        return "text"
+    
+    def _resume_job(self, job: dict):
+        """Requeue a journaled job on its lane; finished stages are reused, not re-run"""
+        lane = self.classify_lane(job["body"], job["media_content_type"], job["num_media"] or 0)
+        ticket = self.outbound.reserve(job["from_number"])
+        return self.scheduler.submit(lane, self.handle_message_profiled, ticket=ticket, **job)
+    
+    def _remember(self, from_number: str, kind: str, text: str, job_id: str = None):
+        """Index an OCR result / transcript for /search (failed extractions are skipped)"""
+        if not self.ocr_store or not text or isinstance(text, FailedResult):
+            return
+        try:
+            self.ocr_store.add(from_number, kind, text, job_id)
         except Exception as e:
-            logger.error(f"Error in AI chat: {e}")
-            return f"Error communicating with AI: {str(e)}"
+            logger.warning(f"Couldn't index {kind} for search: {e}")
+    
+    def search_history(self, from_number: str, terms: str) -> str:
+        """Answer /search from the user's indexed OCR results and transcripts"""
+        if not self.ocr_store:
+            return "❌ Search is not enabled."
+        if not terms:
+            return "🔎 Usage: /search <words>\nExample: /search invoice march"
+        results = self.ocr_store.search(from_number, terms)
+        if not results:
+            return f"🔎 Nothing found for \"{terms}\"."
+        lines = [f"🔎 *Results for \"{terms}\":*"]
+        for i, result in enumerate(results, 1):
+            icon = "🎤" if result["kind"] == "audio" else "📄"
+            date = datetime.fromtimestamp(result["created"]).strftime("%d %b %Y")
+            lines.append(f"\n{i}. {icon} {date}\n{result['snippet']}")
+        return '\n'.join(lines)
+    
+    def handle_message_profiled(self, ticket: Optional[int] = None, **kwargs) -> str:
+        """handle_message, profiled if this request is sampled"""
+        try:
+            with self.profiler.request(), self.memory.request():
+                return self.handle_message(ticket=ticket, **kwargs)
+        finally:
+            # Nothing sent (duplicate, crash) - later replies to this user mustn't wait on it
+            if ticket is not None:
+                self.outbound.release(kwargs["from_number"], ticket)
+    
+    def _context_lock(self, user_number: Optional[str]):
+        """Lock guarding one user's conversation history"""
+        if not user_number:
+            return nullcontext()
+        with self.context_locks_guard:
+            return self.context_locks.setdefault(user_number, threading.Lock())
+    
+    def _stage(self, name: str):
+        """Context marking a pipeline stage for the profiler and memory telemetry"""
+        return self.memory.stage(name, self.profiler.stage(name))
     
     def handle_message(self, from_number: str, body: str = None, media_url: str = None, 
-                       media_content_type: str = None, num_media: int = 0) -> str:
-        """Handle incoming WhatsApp message from Twilio"""
+                       media_content_type: str = None, num_media: int = 0,
+                       reply: Optional[InlineReply] = None, job_id: str = None,
+                       ticket: Optional[int] = None) -> str:
+        """
+        Handle incoming WhatsApp message from Twilio
+        
+        Args:
+            reply: Inline TwiML hand-off, if the webhook is waiting for one
+            job_id: Twilio MessageSid - stages are journaled under it and resumed after a restart
+            ticket: Place in the sender's reply order (OutboundDispatcher.reserve)
+        """
         try:
             logger.info(f"Received message from {from_number}")
             
+            if self.journal and job_id:
+                if not self.journal.take(job_id):
+                    logger.info(f"Reply to {job_id} already sent, ignoring retry")
+                    return None
+                # Answer ready before a restart - just send it
+                answered = self.journal.get_stage(job_id, ANSWERED)
+                if answered is not None:
+                    self._reply(from_number, reply, answered, job_id, ticket)
+                    return answered
+            
             # Handle text messages
             if body and num_media == 0:
                 # Check for commands
-                if body.lower() in ['/start', 'start', 'hello', 'hi']:
+                if body.lower() in START_COMMANDS:
                     response = ("👋 Hello! I'm your AI assistant.\n\n"
                                "I can help you with:\n"
                                "📝 Text - Chat and answer questions\n"
                                "🎤 Audio - Transcribe voice messages\n"
                                "🖼️ Image - Extract text and analyze content\n\n"
+                               "Type /search <words> to find text from your past images and voice notes\n"
                                "Type /reset to clear conversation history")
-                    self.send_message(from_number, response)
+                    self._reply(from_number, reply, response, job_id, ticket)
+                    return response
+                
+                elif is_search_command(body):
+                    response = self.search_history(from_number, body.strip()[len(SEARCH_COMMAND):].strip())
+                    self._reply(from_number, reply, response, job_id, ticket)
                     return response
                 
-                elif body.lower() in ['/reset', 'reset']:
-                    self.conversation_contexts[from_number] = []
+                elif body.lower() in RESET_COMMANDS:
+                    with self._context_lock(from_number):
+                        self.conversation_contexts[from_number] = []
                     response = "✅ Conversation history cleared!"
-                    self.send_message(from_number, response)
+                    self._reply(from_number, reply, response, job_id, ticket)
                     return response
                 
                 else:
-                    response = self.chat_with_ai_free(body, from_number)
-                    self.send_message(from_number, response)
+                    # Over quota: refuse before spending any provider tokens
+                    response = self.usage.check_quota(from_number)
+                    if response is None:
+                        response = self._journaled(job_id, ANSWERED, lambda: self.chat_with_ai_free(body, from_number))
+                    self._reply(from_number, reply, response, job_id, ticket)
                     return response
             
             # Handle media messages
             elif num_media > 0 and media_url:
+                refusal = self.usage.check_quota(from_number)
+                if refusal:
+                    self._reply(from_number, reply, refusal, job_id, ticket)
+                    return refusal
+                
                 # Download media
-                media_data = self.download_media(media_url)
+                media_data = self._journaled(job_id, DOWNLOADED, lambda: self.download_media(media_url))
                 
                 if not media_data:
                     response = "❌ Sorry, couldn't download the media."
-                    self.send_message(from_number, response)
+                    self._reply(from_number, reply, response, job_id, ticket)
                     return response
                 
                 # Handle audio
@@ -302,37 +752,47 @@ class WhatsAppBotFree:
                     if audio_format == 'mpeg':
                         audio_format = 'mp3'
                     
-                    transcription = self.process_audio_free(media_data, audio_format)
+                    transcription = self._journaled(
+                        job_id, TRANSCRIBED, lambda: self.process_audio_free(media_data, audio_format, from_number)
+                    )
+                    self._remember(from_number, "audio", transcription, job_id)
+                    
+                    def answer():
+                        ai_response = self.chat_with_ai_free(transcription, from_number, message_type="audio")
+                        full = f"🎤 *Transcription:*\n{transcription}\n\n💬 *AI Response:*\n{ai_response}"
+                        failed = isinstance(transcription, FailedResult) or isinstance(ai_response, FailedResult)
+                        return FailedResult(full) if failed else full
                     
-                    response = f"🎤 *Transcription:*\n{transcription}\n\n💬 *AI Response:*\n"
-                    ai_response = self.chat_with_ai_free(transcription, from_number)
-                    full_response = response + ai_response
+                    # ANSWERED holds the whole reply, so a resume sends exactly what this would have
+                    full_response = self._journaled(job_id, ANSWERED, answer)
                     
-                    self.send_message(from_number, full_response)
+                    self._reply(from_number, reply, full_response, job_id, ticket)
                     return full_response
                 
                 # Handle images
                 elif media_content_type and 'image' in media_content_type:
                     query = body if body else "What's in this image?"
-                    description = self.process_image_free(media_data, query)
+                    description = self._journaled(job_id, OCR, lambda: self.process_image_free(media_data, query, from_number))
+                    if description.startswith(OCR_HEADER):
+                        self._remember(from_number, "image", description[len(OCR_HEADER):], job_id)
                     
-                    self.send_message(from_number, description)
+                    self._reply(from_number, reply, description, job_id, ticket)
                     return description
                 
                 else:
                     response = f"❌ Unsupported media type: {media_content_type}"
-                    self.send_message(from_number, response)
+                    self._reply(from_number, reply, response, job_id, ticket)
                     return response
             
             else:
                 response = "❌ No message content received"
-                self.send_message(from_number, response)
+                self._reply(from_number, reply, response, job_id, ticket)
                 return response
         
         except Exception as e:
             logger.error(f"Error handling message: {e}")
             error_response = "❌ Sorry, an error occurred while processing your message."
-            self.send_message(from_number, error_response)
+            self._reply(from_number, reply, error_response, job_id, ticket)
             return error_response
 
 
@@ -358,17 +818,56 @@ def webhook():
         
         logger.info(f"Webhook received from {from_number}: {body} (Media: {num_media})")
         
-        # Process message
-        bot.handle_message(
+        # Users live on the node that owns their number - forward if that isn't us
+        if bot.cluster:
+            if bot.cluster.is_trusted(request.headers):
+                bot.cluster.count("received")
+            elif not from_number:
+                # Nothing to route on - not a user message, handle it here
+                bot.cluster.count("local")
+            else:
+                owner_id, owner_url = bot.cluster.owner(from_number)
+                if owner_id != bot.cluster.node_id:
+                    forwarded = bot.cluster.forward(owner_url, request.path, request.form.to_dict())
+                    if forwarded is not None:
+                        return forwarded
+                    logger.warning(f"Node {owner_id} unreachable, handling {from_number} locally")
+                bot.cluster.count("local")
+        
+        resp = MessagingResponse()
+        
+        # Journal the job before queueing it: a Twilio retry of a message that is
+        # still queued or running is dropped here instead of being handled twice
+        job_id = request.form.get('MessageSid')
+        if bot.journal and job_id:
+            if not bot.journal.start_job(job_id, from_number, body, media_url, media_content_type, num_media):
+                logger.info(f"Duplicate delivery of {job_id}, already handled")
+                return str(resp), 200
+        
+        # Queue on the message's priority lane so text isn't stuck behind OCR/transcription;
+        # the ticket keeps one sender's replies in arrival order
+        lane = bot.classify_lane(body, media_content_type, num_media)
+        reply = InlineReply() if bot.inline_reply_deadline > 0 else None
+        job = bot.scheduler.submit(
+            lane,
+            bot.handle_message_profiled,
+            ticket=bot.outbound.reserve(from_number),
             from_number=from_number,
             body=body,
             media_url=media_url,
             media_content_type=media_content_type,
-            num_media=num_media
+            num_media=num_media,
+            reply=reply,
+            job_id=job_id
         )
         
-        # Return empty response
-        resp = MessagingResponse()
+        # Answer inline if the reply is ready before the deadline
+        if reply is not None:
+            inline_message = reply.wait(bot.inline_reply_deadline, done=job)
+            if inline_message is not None:
+                resp.message(inline_message)
+        
+        # Empty response otherwise - the reply follows through the REST API
         return str(resp), 200
     
     except Exception as e:
@@ -382,6 +881,61 @@ def health():
     """Health check endpoint"""
     return {"status": "healthy", "service": "whatsapp-bot-free"}, 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Bot counters (cache hit rate, latency saved, ...)"""
+    return bot.get_metrics(), 200
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    """
+    Profiling data (requires X-Debug-Token = DEBUG_TOKEN)
+    
+    GET: stage stats as JSON, or folded stacks for flame graphs with ?format=folded
+    POST: {"enabled": true, "sample_rate": 0.05, "reset": false} to change settings at runtime
+    """
+    debug_token = os.getenv('DEBUG_TOKEN')
+    if not debug_token:
+        return {"error": "not found"}, 404
+    if not hmac.compare_digest(request.headers.get('X-Debug-Token', ''), debug_token):
+        return {"error": "forbidden"}, 403
+    
+    if request.method == 'POST':
+        settings = request.get_json(silent=True)
+        if not isinstance(settings, dict):
+            return {"error": "body must be a JSON object"}, 400
+        # JSON booleans only - "false" or 0 would otherwise switch profiling on
+        for flag in ('enabled', 'reset'):
+            if settings.get(flag) is not None and not isinstance(settings[flag], bool):
+                return {"error": f"{flag} must be true or false"}, 400
+        sample_rate = settings.get('sample_rate')
+        if sample_rate is not None:
+            if isinstance(sample_rate, bool) or not isinstance(sample_rate, (int, float)) or not 0 <= sample_rate <= 1:
+                return {"error": "sample_rate must be a number between 0 and 1"}, 400
+            sample_rate = float(sample_rate)
+        bot.profiler.configure(
+            enabled=settings.get('enabled'),
+            sample_rate=sample_rate,
+            reset=settings.get('reset') is True
+        )
+    elif request.args.get('format') == 'folded':
+        return bot.profiler.folded_stacks(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    return bot.profiler.get_stats(), 200
+
+@app.route('/cluster', methods=['GET', 'POST'])
+def cluster():
+    """Ring membership (node URLs, so nodes only); POST {"nodes": {"a": "http://host:port", ...}} to rebalance"""
+    if not bot.cluster:
+        return {"error": "cluster mode is off"}, 404
+    if not bot.cluster.is_trusted(request.headers):
+        return {"error": "forbidden"}, 403
+    if request.method == 'POST':
+        nodes = (request.get_json(silent=True) or {}).get('nodes') or {}
+        if bot.cluster.node_id not in nodes:
+            return {"error": "nodes must include this node"}, 400
+        bot.cluster.set_nodes(nodes)
+    return bot.cluster.get_stats(include_nodes=True), 200
+
 @app.route('/', methods=['GET'])
 def home():
     """Homepage with status"""